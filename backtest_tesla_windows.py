@@ -0,0 +1,459 @@
+#!/usr/bin/env python3
+
+# Runs the decisions of check_tesla_windows_mqtt.py over recordings made with its [Record] section, for one or more sets of
+# thresholds, and reports what each set would have done: how many times it would have closed the windows (for rain from a
+# station, rain from OWM, and at sunset), how many rain showers it would have missed, how much of the time the cabin would have
+# been worth cooling and about how many API calls it would have cost. Nothing is called, the rules are evaluated on NumPy arrays
+# built once from the recordings, so months of history take seconds.
+#
+# A shower is a run of rain at a station (readings with rain less than 'rain_window' seconds apart) adding up to at least
+# --shower cm. It's missed when a vehicle was parked with its windows opened within range of that station during the shower
+# and no rule closed them before it ended. A close for rain that didn't happen during or around a shower is counted as false.
+# We only know what the windows did in the recording, so once a rule closes them we assume they stay closed until the recording
+# shows them being opened again. API calls assume a poll of every vehicle every 'tick' seconds, without adaptive polling.
+#
+# Usage: backtest_tesla_windows.py recording.jsonl.gz [more.jsonl.gz ...] [--config check_tesla_windows_mqtt.ini]
+#        [--rule rain_start=0.1,0.3,0.6] [--rule rain_icon_min=9,10] [--shower 0.1] [--json results.json]
+
+import sys
+import os
+import json
+import math
+import argparse
+import itertools
+import configparser
+from datetime import datetime, timedelta
+
+from replay_tesla_windows import load_recording
+
+try:
+    import numpy as np
+except ImportError:
+    print("backtest_tesla_windows.py needs NumPy (pip install numpy)")
+    sys.exit(1)
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "check_tesla_windows_mqtt.py")
+
+# The thresholds a rule set can change, with the config option check_tesla_windows_mqtt.py reads them from and its default there.
+# A rule set that works out can be deployed by setting those options
+RULES = {
+    "tick": ("Timers", "Timer", 60.0),                 # Seconds between polls of a vehicle
+    "rain_window": ("MQTT", "rain_window", 600.0),     # Seconds of station readings the rain rate is computed over
+    "rain_start": ("MQTT", "rain_start", 0.3),         # cm/h at which a station starts raining
+    "rain_stop": ("MQTT", "rain_stop", 0.0),           # cm/h at which it stops
+    "temp_window": ("MQTT", "temp_window", 300.0),     # Seconds of station readings the outside temperature is averaged over
+    "max_distance": ("MQTT", "max_distance", 5.0),     # km from a station its rain counts, for every station
+    "owm_refresh": ("OWM", "refresh", 600.0),          # Seconds an OWM answer is kept
+    "rain_icon_min": ("OWM", "rain_icon_min", 9.0),    # OWM icons from 'rain_icon_min' to 'rain_icon_max' mean rain
+    "rain_icon_max": ("OWM", "rain_icon_max", 11.0),
+    "sunny_icon_max": ("Heat", "sunny_icon_max", 3.0), # OWM daytime icons up to that show some sun
+    "sun_margin": ("Heat", "sun_margin", 3.0),         # Hours after sunrise and before sunset the sun is too low to heat the cabin
+    "warm_temp": ("Heat", "warm_temp", 10.0),          # Above that (C) and sunny, the cabin can overheat
+    "min_soc": ("Heat", "min_soc", 20.0),              # Battery level (%) needed to keep the vehicle awake for it
+}
+
+def printWithTime(text):
+    print(datetime.now().strftime("%H:%M:%S") + " : " + text)
+
+# Index of the last element of the sorted 'times' at or before each of 'at', -1 when there's none yet
+def last_index(times, at):
+    return np.searchsorted(times, at, side="right") - 1
+
+# Great circle distance in km, like Geofence.distance() in check_tesla_windows_mqtt.py
+def distance(latitude1, longitude1, latitude2, longitude2):
+    lat1 = np.radians(latitude1)
+    lat2 = np.radians(latitude2)
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin(np.radians(longitude2 - longitude1) / 2) ** 2
+    return 2 * 6371.0088 * np.arcsin(np.minimum(1.0, np.sqrt(a)))
+
+# Carries the last value that isn't 'missing' forward
+def forward_fill(values, missing):
+    index = np.where(values != missing, np.arange(len(values)), -1)
+    index = np.maximum.accumulate(index)
+    filled = np.where(index >= 0, values[np.maximum(index, 0)], missing)
+    return filled
+
+# The stations of the config, in the same order as check_tesla_windows_mqtt.py
+def read_stations(Config):
+    stations = []
+    if Config.has_option('MQTT', 'latitude') and Config.get('MQTT', 'latitude') != "":
+        stations.append({"name": "station", "topic": Config.get('MQTT', 'topic', fallback="acurite/loop"),
+                         "latitude": float(Config.get('MQTT', 'latitude')), "longitude": float(Config.get('MQTT', 'longitude')),
+                         "max_distance": float(Config.get('MQTT', 'max_distance'))})
+    for section in Config.sections():
+        if section.startswith("Station "):
+            stations.append({"name": section[8:].strip(), "topic": Config.get(section, 'topic'),
+                             "latitude": float(Config.get(section, 'latitude')), "longitude": float(Config.get(section, 'longitude')),
+                             "max_distance": float(Config.get(section, 'max_distance'))})
+    return stations
+
+# What the rule sets start from: the values of the config, or the defaults of check_tesla_windows_mqtt.py
+def default_rules(Config):
+    rules = {}
+    for name, (section, option, default) in RULES.items():
+        rules[name] = default
+        if Config.has_option(section, option) and Config.get(section, option) != "":
+            rules[name] = float(Config.get(section, option))
+    rules["max_distance"] = None # Each station keeps its own unless a rule set changes it
+    return rules
+
+# One vehicle state from a Tessie 'state' answer or a pushed one, None if it's missing a section, like VehicleSnapshot
+def read_state(state):
+    vehicle_state = state.get("vehicle_state")
+    climate_state = state.get("climate_state")
+    charge_state = state.get("charge_state")
+    drive_state = state.get("drive_state")
+    if vehicle_state is None or drive_state is None or climate_state is None or charge_state is None:
+        return None
+    try:
+        windows = int(vehicle_state['fd_window']) + int(vehicle_state['fp_window']) + int(vehicle_state['rd_window']) + int(vehicle_state['rp_window'])
+    except (KeyError, TypeError, ValueError):
+        return None
+    shift_state = drive_state.get('shift_state')
+
+    def number(value):
+        return float(value) if value is not None else math.nan
+
+    return (windows > 0, shift_state is None or shift_state == "P", number(drive_state.get('latitude')), number(drive_state.get('longitude')),
+            number(charge_state.get('battery_level')), number(climate_state.get('outside_temp')))
+
+# Turns the recorded events into arrays: the readings of each station, the states of each vehicle, OWM's weather and the
+# windows closed in the recording
+def load_history(events, Config):
+    stations = read_stations(Config)
+    by_topic = {station["topic"]: station for station in stations}
+    push_topic = Config.get('Push', 'topic', fallback=None)
+    vins = [vin.strip() for vin in Config.get('Tesla', 'vin', fallback="").split(",") if vin.strip() != ""]
+
+    readings = {station["name"]: [] for station in stations}
+    states = {}
+    weather = []
+    closes = []
+    for event in events:
+        if event["kind"] == "mqtt":
+            station = by_topic.get(event["topic"])
+            try:
+                payload = json.loads(event["payload"])
+            except ValueError:
+                continue
+            if station is not None:
+                try:
+                    rain = float(payload.get("rain_cm") or 0.0)
+                    out_temp = payload.get("outTemp_C")
+                    readings[station["name"]].append((event["t"], rain, float(out_temp) if out_temp is not None else math.nan))
+                except (ValueError, AttributeError):
+                    pass
+            elif event["topic"] == push_topic and isinstance(payload, dict):
+                vin = payload.get("vin", vins[0] if len(vins) == 1 else None)
+                state = read_state(payload)
+                if vin is not None and state is not None:
+                    states.setdefault(vin, []).append((event["t"],) + state)
+        elif event["kind"] == "http" and event["status"] == 200:
+            path = event["url"].split("?")[0]
+            if path.startswith("/data/2.5/weather"):
+                try:
+                    data = json.loads(event["body"])
+                    icon = data['weather'][0]['icon']
+                    weather.append((event["t"], int(icon[0:2]), icon[2:3] == "d", float(data['main']['temp']) - 273.15 if "temp" in data['main'] else math.nan))
+                except (ValueError, KeyError, IndexError, TypeError):
+                    pass
+            elif path.endswith("/state"):
+                try:
+                    state = read_state(json.loads(event["body"]))
+                except ValueError:
+                    state = None
+                if state is not None:
+                    states.setdefault(path.split("/")[1], []).append((event["t"],) + state)
+            elif path.endswith("/command/close_windows"):
+                closes.append((event["t"], path.split("/")[1]))
+
+    history = {"stations": [], "vehicles": {}, "closes": closes}
+    for station in stations:
+        rows = np.array(readings[station["name"]], dtype=float).reshape(-1, 3)
+        history["stations"].append(dict(station, t=rows[:, 0], rain=rows[:, 1], temp=rows[:, 2]))
+    for vin, rows in states.items():
+        rows.sort(key=lambda row: row[0])
+        columns = list(zip(*rows))
+        history["vehicles"][vin] = {"t": np.array(columns[0]), "open": np.array(columns[1], dtype=bool), "parked": np.array(columns[2], dtype=bool),
+                                    "latitude": np.array(columns[3]), "longitude": np.array(columns[4]), "soc": np.array(columns[5]), "out_temp": np.array(columns[6])}
+    rows = np.array(weather, dtype=float).reshape(-1, 4)
+    history["weather"] = {"t": rows[:, 0], "icon": rows[:, 1].astype(int), "day": rows[:, 2].astype(bool), "temp": rows[:, 3]}
+    history["start"] = events[0]["t"]
+    history["end"] = events[-1]["t"]
+    return history
+
+# Sunrise and sunset (epoch) of every local day of the history, at our first station like check_tesla_windows_mqtt.py when it
+# doesn't know where the vehicle is
+def sun_times(history, latitude, longitude):
+    from suntime import Sun
+    import pytz
+
+    local = pytz.timezone('America/Toronto')
+    sun = Sun(latitude, longitude)
+    day = datetime.fromtimestamp(history["start"], local).date()
+    last = datetime.fromtimestamp(history["end"], local).date()
+    days = []
+    while day <= last:
+        sunrise = sun.get_sunrise_time(day)
+        sunset = sun.get_sunset_time(day)
+        if sunrise > sunset:
+            sunset = sunset + timedelta(days=1) # Same fix as Ephemeris.get()
+        midnight = local.localize(datetime(day.year, day.month, day.day))
+        days.append((midnight.timestamp(), sunrise.timestamp(), sunset.timestamp()))
+        day = day + timedelta(days=1)
+    return np.array(days, dtype=float).reshape(-1, 3)
+
+# When each station was raining by 'rules' (the rain rate of the last 'rain_window' seconds with hysteresis, like Station.update())
+# at each of its readings, and the times it started raining
+def station_rain(station, rules):
+    t = station["t"]
+    total = np.concatenate(([0.0], np.cumsum(station["rain"])))
+    first = np.searchsorted(t, t - rules["rain_window"], side="right") # Readings older than the window don't count
+    rain = total[1:] - total[first]
+    rate = rain * 3600.0 / rules["rain_window"]
+
+    marks = np.full(len(t), -1)
+    marks[rate <= rules["rain_stop"]] = 0
+    marks[(rain > 0.0) & (rate >= rules["rain_start"])] = 1
+    raining = forward_fill(marks, -1) == 1
+    started = raining & ~np.concatenate(([False], raining[:-1]))
+    return raining, t[started]
+
+# Mean outside temperature of the station's readings in the 'window' seconds before each of 'at', NaN when it has none, like
+# Station.temp_window
+def station_temperature(station, at, window):
+    t = station["t"]
+    known = ~np.isnan(station["temp"])
+    count = np.concatenate(([0], np.cumsum(known)))
+    total = np.concatenate(([0.0], np.cumsum(np.where(known, station["temp"], 0.0))))
+    last = np.searchsorted(t, at, side="right")
+    first = np.searchsorted(t, at - window, side="right")
+    readings = count[last] - count[first]
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return np.where(readings > 0, (total[last] - total[first]) / readings, np.nan)
+
+# Runs of rain at a station, readings with rain less than 'gap' seconds apart, with at least 'amount' cm. Returns their start and end
+def showers(station, gap, amount):
+    wet = station["rain"] > 0.0
+    t = station["t"][wet]
+    rain = station["rain"][wet]
+    if len(t) == 0:
+        return np.zeros(0), np.zeros(0)
+    new = np.concatenate(([True], np.diff(t) > gap))
+    group = np.cumsum(new) - 1
+    totals = np.bincount(group, weights=rain)
+    starts = t[new]
+    ends = t[np.concatenate((new[1:], [True]))]
+    keep = totals >= amount
+    return starts[keep], ends[keep]
+
+# Everything that can happen to one vehicle's windows with 'rules'. Pure: only reads 'history'
+def evaluate_vehicle(history, vehicle, rules, ticks, sun, shower_amount):
+    stations = history["stations"]
+    weather = history["weather"]
+    radius = [station["max_distance"] if rules["max_distance"] is None else rules["max_distance"] for station in stations]
+
+    # The windows of a recorded state belong to an episode, a run of states parked with the windows opened. A rule that
+    # closes them ends that episode, the next one starts when the recording shows them opened again
+    opened = vehicle["open"] & vehicle["parked"]
+    episodes = np.where(opened, np.cumsum(opened & ~np.concatenate(([False], opened[:-1]))), 0)
+
+    def state_at(at):
+        index = last_index(vehicle["t"], at)
+        known = index >= 0
+        index = np.maximum(index, 0)
+        return known, index
+
+    # Which station covers the vehicle at those times: the closest one, if it's within its range
+    def covering(at):
+        known, index = state_at(at)
+        if len(stations) == 0:
+            return np.full(len(at), -1)
+        distances = np.stack([distance(station["latitude"], station["longitude"], vehicle["latitude"][index], vehicle["longitude"][index]) for station in stations], axis=1)
+        nearest = np.argmin(np.where(np.isnan(distances), np.inf, distances), axis=1)
+        near = distances[np.arange(len(at)), nearest] <= np.array(radius)[nearest]
+        return np.where(known & near, nearest, -1)
+
+    triggers = [] # (times, kind)
+    rain_checks = 0
+
+    # A station starting to rain checks the vehicles it covers
+    raining_at_ticks = np.zeros((len(stations), len(ticks)), dtype=bool)
+    for s, station in enumerate(stations):
+        raining, started = station_rain(station, rules)
+        if len(station["t"]) > 0:
+            index = last_index(station["t"], ticks)
+            raining_at_ticks[s] = (index >= 0) & raining[np.maximum(index, 0)] & (ticks - station["t"][np.maximum(index, 0)] < rules["rain_window"])
+        covered = covering(started) == s
+        rain_checks += int(np.count_nonzero(covered))
+        triggers.append((started[covered], "rain"))
+
+    # OWM reporting rain where the vehicle is, when no station covering it already does
+    station_at_ticks = covering(ticks)
+    station_raining = np.zeros(len(ticks), dtype=bool)
+    has_station = station_at_ticks >= 0
+    station_raining[has_station] = raining_at_ticks[station_at_ticks[has_station], np.nonzero(has_station)[0]]
+    w = last_index(weather["t"], ticks)
+    has_weather = (w >= 0) & (ticks - weather["t"][np.maximum(w, 0)] < 2 * rules["owm_refresh"])
+    w = np.maximum(w, 0)
+    icon = weather["icon"][w] if len(weather["t"]) > 0 else np.zeros(len(ticks), dtype=int)
+    day = weather["day"][w] if len(weather["t"]) > 0 else np.zeros(len(ticks), dtype=bool)
+    owm_rain = has_weather & (icon >= rules["rain_icon_min"]) & (icon <= rules["rain_icon_max"]) & ~station_raining
+    triggers.append((ticks[owm_rain], "owm"))
+
+    # The first tick after each sunset
+    d = np.clip(np.searchsorted(sun[:, 0], ticks, side="right") - 1, 0, len(sun) - 1)
+    night = (ticks < sun[d, 1]) | (ticks > sun[d, 2])
+    first_night = night & ~np.concatenate(([True], night[:-1]))
+    triggers.append((ticks[first_night], "sunset"))
+
+    # Sunny mid-day, warm and enough battery to keep the cabin cool
+    known, index = state_at(ticks)
+    out_temp = np.where(known, vehicle["out_temp"][index], np.nan)
+    for s, station in enumerate(stations): # Then the station covering it, then OWM
+        use = np.isnan(out_temp) & (station_at_ticks == s)
+        if np.any(use):
+            out_temp[use] = station_temperature(station, ticks[use], rules["temp_window"])
+    if len(weather["t"]) > 0:
+        out_temp = np.where(np.isnan(out_temp), weather["temp"][w], out_temp)
+    soc = np.where(known, vehicle["soc"][index], np.nan)
+    mid_day = (ticks > sun[d, 1] + rules["sun_margin"] * 3600) & (ticks < sun[d, 2] - rules["sun_margin"] * 3600)
+    with np.errstate(invalid="ignore"):
+        heat = has_weather & (icon <= rules["sunny_icon_max"]) & day & mid_day & (out_temp > rules["warm_temp"]) & (soc >= rules["min_soc"])
+
+    # Each episode is closed by its first trigger
+    times = np.concatenate([at for at, kind in triggers])
+    kinds = np.concatenate([np.full(len(at), kind) for at, kind in triggers])
+    order = np.argsort(times, kind="stable")
+    times = times[order]
+    kinds = kinds[order]
+    known, index = state_at(times)
+    episode = np.where(known, episodes[index], 0)
+    acted = episode > 0
+    closed, first = np.unique(episode[acted], return_index=True)
+    close_times = times[acted][first]
+    close_kinds = kinds[acted][first]
+
+    # Showers at the stations covering the vehicle, and whether its windows were closed before each one ended
+    missed = 0
+    wet_seconds = 0.0
+    rain_closes = close_times[close_kinds != "sunset"]
+    confirmed = np.zeros(len(rain_closes), dtype=bool)
+    closed_at = dict(zip(closed.tolist(), close_times.tolist()))
+    for s, station in enumerate(stations):
+        starts, ends = showers(station, rules["rain_window"], shower_amount)
+        for start, end in zip(starts, ends):
+            confirmed |= (rain_closes >= start - rules["rain_window"]) & (rain_closes <= end + rules["rain_window"])
+            first_state = max(last_index(vehicle["t"], np.array([start]))[0], 0)
+            last_state = last_index(vehicle["t"], np.array([end]))[0]
+            if last_state < 0:
+                continue
+            span = np.arange(first_state, last_state + 1)
+            span = span[episodes[span] > 0]
+            if len(span) == 0 or not np.any(covering(np.maximum(vehicle["t"][span], start)) == s):
+                continue
+            for e in np.unique(episodes[span]):
+                shut = closed_at.get(int(e))
+                opened_at = max(start, vehicle["t"][span][episodes[span] == e][0])
+                if shut is None or shut > end:
+                    missed += 1
+                    wet_seconds += end - opened_at
+                elif shut > opened_at:
+                    wet_seconds += shut - opened_at
+
+    tick = rules["tick"]
+    return {
+        "rain_closes": int(np.count_nonzero(close_kinds == "rain")),
+        "owm_closes": int(np.count_nonzero(close_kinds == "owm")),
+        "sunset_closes": int(np.count_nonzero(close_kinds == "sunset")),
+        "false_closes": int(np.count_nonzero(~confirmed)),
+        "missed_showers": missed,
+        "wet_minutes": round(wet_seconds / 60.0, 1),
+        "heat_hours": round(np.count_nonzero(heat) * tick / 3600.0, 1),
+        "tessie_calls": int(2 * len(ticks) + 2 * rain_checks + len(closed)),
+    }
+
+# What a rule set would have done over the whole history, for all the vehicles
+def evaluate(history, rules, sun, shower_amount):
+    ticks = np.arange(history["start"], history["end"], rules["tick"])
+    totals = {}
+    for vin, vehicle in sorted(history["vehicles"].items()):
+        for name, value in evaluate_vehicle(history, vehicle, rules, ticks, sun, shower_amount).items():
+            totals[name] = round(totals.get(name, 0) + value, 1)
+    if len(history["weather"]["t"]) > 0:
+        totals["owm_calls"] = int(len(np.unique(np.floor(ticks / rules["owm_refresh"]))))
+    else:
+        totals["owm_calls"] = 0
+    return totals
+
+# The rule sets to try: every combination of the values given with --rule, the others staying at their default
+def rule_sets(defaults, overrides):
+    names = [name for name, values in overrides]
+    sets = []
+    for values in itertools.product(*[values for name, values in overrides]):
+        rules = dict(defaults)
+        rules.update(zip(names, values))
+        sets.append((dict(zip(names, values)), rules))
+    return sets
+
+def parse_rule(text):
+    name, _, values = text.partition("=")
+    name = name.strip()
+    if name not in RULES:
+        raise argparse.ArgumentTypeError("unknown rule '" + name + "', use one of " + ", ".join(RULES))
+    try:
+        return name, [float(value) for value in values.split(",") if value.strip() != ""]
+    except ValueError:
+        raise argparse.ArgumentTypeError("values of '" + name + "' must be numbers")
+
+def print_results(history, results):
+    hours = (history["end"] - history["start"]) / 3600.0
+    recorded = len(history["closes"])
+    print("Backtested " + str(timedelta(seconds=int(hours * 3600))) + " of history, " + str(len(history["vehicles"])) + " vehicle(s), " + str(recorded) + " close_windows in the recording")
+    columns = ("rain_closes", "owm_closes", "sunset_closes", "false_closes", "missed_showers", "wet_minutes", "heat_hours", "tessie_calls", "owm_calls")
+    print("  ".join(["rules".ljust(30)] + [column for column in columns]))
+    for changed, totals in results:
+        label = ", ".join(name + "=" + ("%g" % value) for name, value in changed.items()) or "defaults"
+        print("  ".join([label.ljust(30)] + [str(totals.get(column, 0)).rjust(len(column)) for column in columns]))
+
+def main():
+    parser = argparse.ArgumentParser(description="Evaluates the decision rules of check_tesla_windows_mqtt.py over recordings, for one or more sets of thresholds")
+    parser.add_argument("recordings", nargs="+", help="Files written by the [Record] section, in any order")
+    parser.add_argument("--config", default=os.path.join(os.path.dirname(SCRIPT), "check_tesla_windows_mqtt.ini"), help="Config the recordings were made with")
+    parser.add_argument("--rule", type=parse_rule, action="append", default=[], help="Values to try for a threshold, like rain_start=0.1,0.3,0.6. One of: " + ", ".join(RULES))
+    parser.add_argument("--shower", type=float, default=0.1, help="Rain (cm) a run of rain at a station needs to count as a shower")
+    parser.add_argument("--json", help="Also write the results to that file, to compare runs")
+    args = parser.parse_args()
+
+    Config = configparser.ConfigParser()
+    Config.read(args.config)
+
+    events = []
+    for recording in args.recordings:
+        events.extend(load_recording(recording))
+    events.sort(key=lambda event: event["t"])
+    if len(events) == 0:
+        print("Nothing to backtest in " + ", ".join(args.recordings))
+        sys.exit(1)
+
+    printWithTime("Backtest: Loading " + str(len(events)) + " events")
+    history = load_history(events, Config)
+    if len(history["vehicles"]) == 0:
+        print("No vehicle state in the recordings, nothing to decide on")
+        sys.exit(1)
+    if len(history["stations"]) > 0:
+        sun = sun_times(history, history["stations"][0]["latitude"], history["stations"][0]["longitude"])
+    else:
+        sun = np.array([[history["start"], -math.inf, math.inf]]) # No position to compute them, it's never night
+
+    printWithTime("Backtest: Evaluating")
+    results = [(changed, evaluate(history, rules, sun, args.shower)) for changed, rules in rule_sets(default_rules(Config), args.rule)]
+    printWithTime("Backtest: Done")
+
+    print_results(history, results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump([{"rules": changed, "results": totals} for changed, totals in results], f, indent=4)
+
+if __name__ == "__main__":
+    main()
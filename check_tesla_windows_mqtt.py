@@ -1,18 +1,27 @@
 #!/usr/bin/env python3
 
 import sys
-import requests
+import os
 import json
 import time
 import pytz
-from suntime import Sun
-from threading import Timer
+from threading import Lock, Event, Thread, get_ident
+from collections import namedtuple
+import queue
+from urllib.parse import urlsplit
 import smtplib
 import configparser
-import geopy.distance
-import paho.mqtt.client as mqtt
+import math
+import random
+import gzip
+import atexit
+from array import array
 from datetime import datetime, timedelta
-import asyncio 
+import asyncio
+import socket
+
+# requests, paho and suntime are imported where they're first used, so our start up isn't waiting on them
+g_started = time.monotonic() # To measure how long it takes before we're watching for rain
 
 # DEBUG flag
 # 0 No debug
@@ -27,142 +36,902 @@ import asyncio
 # OWM           XXX (0x100,0x200,0x400) map 0x700 
 # Car climate      XXX (0x800,0x1000,0x2000) map 0x3800
 # Time                XX X (0x4000, 0x8000, 0x10000) map 0x1C000
-# Class used to send an email 
+# Class used to send an email. The authenticated session is kept opened between emails and opened again if the server dropped it
 class Emailer:
-    def sendmail(self, recipient, subject, content):
-        SMTP_SERVER = 'smtp.gmail.com' #Email Server (don't change!)
-        SMTP_PORT = 587 #Server Port (don't change!)
+    def __init__(self):
+        self.session = None
+
+    def connect(self):
         GMAIL_USERNAME = Config.get('Email', 'username') #change this to match your gmail account
         GMAIL_PASSWORD = Config.get('Email', 'password') #change this to match your gmail password
 
-        #Create Headers
-        headers = ["From: " + GMAIL_USERNAME, "Subject: " + subject, "To: " + recipient, "MIME-Version: 1.0", "Content-Type: text/html"]
-        headers = "\r\n".join(headers)
-
         #Connect to Gmail Server
-        session = smtplib.SMTP(SMTP_SERVER, SMTP_PORT)
-        session.ehlo()
-        session.starttls()
+        session = smtplib.SMTP(smtp_server, smtp_port, timeout=30)
         session.ehlo()
+        if smtp_tls:
+            session.starttls()
+            session.ehlo()
 
         #Login to Gmail
         session.login(GMAIL_USERNAME, GMAIL_PASSWORD)
+        self.session = session
+
+    def sendmail(self, recipient, subject, content):
+        GMAIL_USERNAME = Config.get('Email', 'username')
+
+        #Create Headers
+        headers = ["From: " + GMAIL_USERNAME, "Subject: " + subject, "To: " + recipient, "MIME-Version: 1.0", "Content-Type: text/html"]
+        headers = "\r\n".join(headers)
 
-        #Send Email & Exit
-        session.sendmail(GMAIL_USERNAME, recipient, headers + "\r\n\r\n" + content)
-        session.quit
+        if self.session is None:
+            self.connect()
+        try:
+            self.session.sendmail(GMAIL_USERNAME, recipient, headers + "\r\n\r\n" + content)
+        except smtplib.SMTPServerDisconnected:
+            # Our kept session was closed by the server, open a new one and try again
+            self.session = None
+            self.connect()
+            self.session.sendmail(GMAIL_USERNAME, recipient, headers + "\r\n\r\n" + content)
+
+    def close(self):
+        if self.session is not None:
+            try:
+                self.session.quit()
+            except Exception:
+                pass
+            self.session = None
+
+# Class used to send our emails from a background thread so nobody waits on the SMTP server. Emails are queued (up to 'size')
+# and retried 'retries' times with an increasing delay. If 'digest' is more than 0, emails queued within that many seconds of
+# each other are sent as a single email
+class EmailOutbox:
+    def __init__(self, size, retries, digest):
+        self.queue = queue.Queue(size)
+        self.retries = retries
+        self.digest = digest
+        self.emailer = Emailer()
+        self.generation = 0 # A thread that isn't of the current generation was replaced and quits as soon as it can
+        self.thread = None
+
+    # Starts the thread sending our emails and returns it. Also used by the supervisor to replace a stuck one
+    def start(self):
+        self.thread = Thread(target=self.run, args=(self.generation,), name="EmailOutbox", daemon=True)
+        self.thread.start()
+        return self.thread
+
+    # Used by the supervisor when our thread is stuck talking to the SMTP server. We can't stop a thread so it's left behind
+    # with its session and the next thread gets a new one
+    def stop(self):
+        self.generation += 1
+        self.emailer = Emailer()
+
+    # Never blocks. Returns False if the queue is full and the email was dropped
+    def send(self, subject, body):
+        if g_recorder is not None:
+            g_recorder.record("email", subject=subject)
+        try:
+            self.queue.put_nowait((subject, body))
+            return True
+        except queue.Full:
+            printWithTime("Tesla-Email: Outbox is full, dropping '" + subject + "'")
+            return False
+
+    # Waits up to 'timeout' seconds for the queued emails to be sent, like before quitting
+    def flush(self, timeout):
+        deadline = time.monotonic() + timeout
+        while self.queue.unfinished_tasks > 0 and time.monotonic() < deadline:
+            time.sleep(0.1)
+
+    def run(self, generation):
+        while generation == self.generation:
+            try:
+                messages = [self.queue.get(timeout=120)]
+            except queue.Empty:
+                self.emailer.close() # Nothing to send for a while, don't keep the session opened for nothing
+                continue
+
+            if self.digest > 0:
+                deadline = time.monotonic() + self.digest
+                while time.monotonic() < deadline:
+                    try:
+                        messages.append(self.queue.get(timeout=deadline - time.monotonic()))
+                    except queue.Empty:
+                        break
+
+            if len(messages) == 1:
+                subject, body = messages[0]
+            else:
+                subject = "Tesla: " + str(len(messages)) + " notifications"
+                body = "<br><br>".join(message[0] + "<br>" + message[1] for message in messages)
+
+            emailer = self.emailer
+            breaker = g_breakers["smtp"]
+            delay = 5
+            attempt = 0
+            while generation == self.generation:
+                # While the SMTP server isn't answering our emails stay queued instead of using up their retries
+                while breaker.wait_time() > 0 and generation == self.generation:
+                    time.sleep(min(breaker.wait_time(), 5))
+                try:
+                    breaker.allow()
+                except CircuitOpen:
+                    continue # Someone else is probing it, that's not a try for this email
+                g_metrics.count("tesla_api_calls_total", api="smtp", command="sendmail")
+                try:
+                    with g_metrics.span("email"), g_supervisor.busy("notifier"):
+                        emailer.sendmail(sendTo, subject, body)
+                    breaker.success()
+                    break
+                except (smtplib.SMTPRecipientsRefused, smtplib.SMTPResponseException) as error:
+                    if isinstance(error, smtplib.SMTPRecipientsRefused) or (error.smtp_code >= 500 and not isinstance(error, smtplib.SMTPAuthenticationError)):
+                        # The server answered, it's this email it won't ever take. Retrying won't help and would only hold the others
+                        breaker.success()
+                        printWithTime("Tesla-Email: Server refused email with exception: " + type(error).__name__ + ", dropping '" + subject + "'")
+                        break
+                    breaker.failure(type(error).__name__)
+                    reason = type(error).__name__
+                except Exception as error:
+                    breaker.failure(type(error).__name__)
+                    reason = type(error).__name__
+                emailer.close()
+                if attempt == self.retries:
+                    printWithTime("Tesla-Email: Unable to send email because of exception: " + reason + ", giving up on '" + subject + "'")
+                    break
+                if (g_debug & 3) > 0:
+                    printWithTime("Tesla-Email: Unable to send email because of exception: " + reason + ", retrying in " + str(delay) + " seconds")
+                time.sleep(delay)
+                delay = delay * 2
+                attempt += 1
+
+            for message in messages:
+                self.queue.task_done()
+
+# Class used to share pooled keep-alive HTTP sessions between our calls to Tessie and OWM so we don't pay a new TCP + TLS handshake on every request
+class HttpClient:
+    def __init__(self, pool_size, timeout):
+        self.pool_size = pool_size
+        self.timeout = timeout
+        self.sessions = {} # One session per host, each with its own pool of keep-alive connections
+        self.lock = Lock()
+
+    def session(self, host):
+        import requests # Our heaviest import, done by the first call to Tessie or OWM in its worker thread while MQTT connects
+
+        with self.lock:
+            session = self.sessions.get(host)
+            if session is None:
+                adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size)
+                session = requests.Session()
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                self.sessions[host] = session
+            return session
+
+    # Every call to 'api' has to fit in its budget. An 'urgent' one (closing the windows) can use what's kept in reserve. Raises
+    # CircuitOpen right away if that api stopped answering
+    def get(self, url, api, headers=None, timeout=None, urgent=False):
+        breaker = g_breakers.get(api)
+        if breaker is not None:
+            breaker.allow()
+        try:
+            g_budgets.spend(api, urgent)
+        except BudgetExhausted:
+            if breaker is not None:
+                breaker.cancel()
+            raise
+        if timeout is None:
+            timeout = self.timeout # Never let a request hang forever
+        try:
+            response = self.session(urlsplit(url).netloc).get(url, headers=headers, timeout=timeout)
+        except Exception as error:
+            if breaker is not None:
+                breaker.failure(type(error).__name__)
+            raise
+        if breaker is not None:
+            if response.status_code >= 500:
+                breaker.failure("status code " + str(response.status_code))
+            else:
+                breaker.success()
+        if g_recorder is not None:
+            g_recorder.record("http", url=url, status=response.status_code, body=response.text)
+        return response
+
+    # Returns how many connections were opened and how many requests reused an already opened connection, per host
+    def stats(self):
+        stats = {}
+        with self.lock:
+            sessions = list(self.sessions.items())
+        for host, session in sessions:
+            new = 0
+            requests_sent = 0
+            for adapter in set(session.adapters.values()): # Same adapter is mounted for http and https
+                for key in adapter.poolmanager.pools.keys():
+                    pool = adapter.poolmanager.pools.get(key)
+                    if pool is not None:
+                        new += pool.num_connections
+                        requests_sent += pool.num_requests
+            stats[host] = (new, requests_sent - new)
+        return stats
+
+    def stats_text(self):
+        return ", ".join(host + " new=" + str(new) + " reused=" + str(reused) for host, (new, reused) in self.stats().items())
+
+# Raised by Budgets.spend() when a call doesn't fit in what's left of its budget
+class BudgetExhausted(Exception):
+    pass
+
+# Class used to limit how many calls we make to each of our APIs (Tessie, OWM) per minute and per UTC day so a flapping station
+# or a restart loop can't burn through OWM's quota or get us rate limited by Tessie. The minute budget is a token bucket refilled
+# continuously. Once a budget is down to its last 'reserve' share, only urgent calls (closing the windows) get through. What's
+# left is kept in our state file (see StateStore) so restarting doesn't give us a fresh budget
+class Budgets:
+    SAVED = ("tokens", "updated", "day", "used")
+
+    def __init__(self, reserve):
+        self.reserve = reserve
+        self.lock = Lock()
+        self.budgets = {}   # api -> {"per_minute", "per_day", "tokens", "updated" (epoch), "day", "used"}
+        self.spent = 0      # Calls let through since we started, so the state file knows when to save us
+
+    # Limits for that api, 0 means no limit
+    def add(self, api, per_minute, per_day):
+        self.budgets[api] = {"per_minute": per_minute, "per_day": per_day, "tokens": float(per_minute), "updated": time.time(), "day": None, "used": 0}
+        g_metrics.gauge("tesla_budget_remaining", lambda: self.remaining(api)[0], api=api, window="minute")
+        g_metrics.gauge("tesla_budget_remaining", lambda: self.remaining(api)[1], api=api, window="day")
+
+    def refill(self, budget, now):
+        budget["tokens"] = min(float(budget["per_minute"]), budget["tokens"] + (now - budget["updated"]) * budget["per_minute"] / 60.0)
+        budget["updated"] = now
+        today = time.strftime("%Y-%m-%d", time.gmtime(now))
+        if budget["day"] != today:
+            budget["day"] = today
+            budget["used"] = 0
+
+    # Takes one call out of the budget of that api, raises BudgetExhausted if it doesn't fit
+    def spend(self, api, urgent):
+        with self.lock:
+            budget = self.budgets.get(api)
+            if budget is None:
+                return
+            now = time.time()
+            self.refill(budget, now)
+            keep = 0.0 if urgent else self.reserve # Routine calls leave the reserve to the urgent ones
+            if budget["per_minute"] > 0 and budget["tokens"] - 1.0 < keep * budget["per_minute"]:
+                reason = "minute"
+            elif budget["per_day"] > 0 and budget["used"] + 1 > budget["per_day"] * (1.0 - keep):
+                reason = "day"
+            else:
+                reason = None
+                budget["tokens"] -= 1.0
+                budget["used"] += 1
+                self.spent += 1
+        if reason is not None:
+            g_metrics.count("tesla_budget_denied_total", api=api, window=reason)
+            if (g_debug & 3) > 0:
+                printWithTime("Tesla-Budget: Not calling " + api + ", its " + reason + " budget is spent")
+            raise BudgetExhausted(api + " " + reason + " budget spent")
+
+    # What's left this minute and today, -1 when it has no limit
+    def remaining(self, api):
+        with self.lock:
+            budget = self.budgets[api]
+            self.refill(budget, time.time())
+            minute = int(budget["tokens"]) if budget["per_minute"] > 0 else -1
+            day = budget["per_day"] - budget["used"] if budget["per_day"] > 0 else -1
+        return minute, day
+
+    # What's left of each budget, for our state file
+    def to_dict(self):
+        with self.lock:
+            return {api: {key: budget[key] for key in self.SAVED} for api, budget in self.budgets.items()}
+
+    def restore(self, saved):
+        with self.lock:
+            for api, budget in self.budgets.items():
+                if api in saved:
+                    budget.update({key: saved[api][key] for key in self.SAVED if key in saved[api]})
+                    budget["tokens"] = min(budget["tokens"], float(budget["per_minute"]))
+
+# Raised instead of calling an API whose circuit is opened
+class CircuitOpen(Exception):
+    pass
+
+# Class used to stop waiting on an API (Tessie, OWM, SMTP) that stopped answering. After 'threshold' failures in a row its circuit
+# opens and calls fail right away. After a backoff of 'backoff' seconds, doubled every time the circuit opens again up to
+# 'max_backoff' and shortened by a random amount so we don't all retry at once, a single call goes through as a probe. The
+# circuit closes if it works and opens again if it doesn't. With 'email', we also send one when it opens and when it closes
+class CircuitBreaker:
+    def __init__(self, name, threshold, backoff, max_backoff, email):
+        self.name = name
+        self.threshold = threshold
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.email = email
+        self.lock = Lock()
+        self.state = "closed"       # "open" while we don't call it, "half-open" while our probe is out
+        self.failures = 0           # In a row
+        self.reopened = 0           # Times our probe failed since it opened
+        self.retry_at = 0.0         # time.monotonic() at which we let a probe through
+        self.opened_at = None       # time.time() at which it opened
+        g_metrics.gauge("tesla_circuit_open", lambda: 0 if self.state == "closed" else 1, api=name.lower())
+
+    # Raises CircuitOpen if we shouldn't call now. Otherwise the caller tells us how it went with success(), failure() or cancel()
+    def allow(self):
+        with self.lock:
+            if self.state == "closed":
+                return
+            if self.state == "open" and time.monotonic() >= self.retry_at:
+                self.state = "half-open" # That caller is our probe, the others keep failing until we know
+                return
+        g_metrics.count("tesla_circuit_rejected_total", api=self.name.lower())
+        raise CircuitOpen(self.name + " isn't answering")
+
+    # Seconds before allow() would let a call through
+    def wait_time(self):
+        with self.lock:
+            if self.state == "closed":
+                return 0.0
+            if self.state == "half-open":
+                return 1.0
+            return max(0.0, self.retry_at - time.monotonic())
+
+    # The call we allowed didn't happen after all. If it was our probe, the next caller probes
+    def cancel(self):
+        with self.lock:
+            if self.state == "half-open":
+                self.state = "open"
+                self.retry_at = 0.0
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            if self.state == "closed":
+                return
+            self.state = "closed"
+            self.reopened = 0
+            down = time.time() - self.opened_at
+        g_metrics.count("tesla_circuit_transitions_total", api=self.name.lower(), to="closed")
+        self.report("Tesla-Circuit: " + self.name + " is answering again after " + str(timedelta(seconds=int(down))))
+
+    def failure(self, reason):
+        with self.lock:
+            self.failures += 1
+            if self.state == "open" or (self.state == "closed" and self.failures < self.threshold):
+                return # Still under our threshold, or a call that started before it opened
+            first = self.state == "closed"
+            if first:
+                self.opened_at = time.time()
+            else:
+                self.reopened += 1 # Our probe failed
+            delay = min(self.backoff * 2 ** self.reopened, self.max_backoff)
+            delay = random.uniform(delay / 2, delay)
+            self.state = "open"
+            self.retry_at = time.monotonic() + delay
+        if first:
+            g_metrics.count("tesla_circuit_transitions_total", api=self.name.lower(), to="open")
+            self.report("Tesla-Circuit: " + self.name + " isn't answering (" + reason + ", " + str(self.threshold) + " failures in a row), trying again in " + str(int(delay)) + " seconds")
+        elif (g_debug & 3) > 0:
+            printWithTime("Tesla-Circuit: " + self.name + " still isn't answering (" + reason + "), trying again in " + str(int(delay)) + " seconds")
+
+    def report(self, text):
+        printWithTime(text)
+        if self.email:
+            send_email(text, text)
+
+# Class used to time the stages of our work (Tessie, OWM, sun, geofences, emails, timer ticks) with the monotonic clock and
+# count API calls and errors. Exposed as Prometheus text on [Metrics] port and/or published as json on [Metrics] topic
+class Metrics:
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0) # Seconds
+
+    def __init__(self):
+        self.lock = Lock()
+        self.histograms = {} # stage -> [count per bucket (the last one is +Inf), sum, count]
+        self.counters = {}   # (name, ((label, value), ...)) -> value
+        self.gauges = {}     # (name, ((label, value), ...)) -> function returning its current value
+
+    def observe(self, stage, seconds):
+        with self.lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = [[0] * (len(self.BUCKETS) + 1), 0.0, 0]
+            i = 0
+            while i < len(self.BUCKETS) and seconds > self.BUCKETS[i]:
+                i += 1
+            histogram[0][i] += 1
+            histogram[1] += seconds
+            histogram[2] += 1
+
+    def count(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    # 'read' is called for the value each time the metrics are asked for
+    def gauge(self, name, read, **labels):
+        with self.lock:
+            self.gauges[(name, tuple(sorted(labels.items())))] = read
+
+    def gauge_values(self):
+        with self.lock:
+            gauges = dict(self.gauges)
+        return {key: read() for key, read in gauges.items()}
+
+    # Times what runs inside 'with g_metrics.span("stage"):' and counts an error for that stage if it raised
+    def span(self, stage):
+        return MetricsSpan(self, stage)
+
+    # Upper bound of the bucket where the 'q' quantile (0 to 1) of that stage falls, None if it never ran
+    def quantile(self, stage, q):
+        with self.lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None or histogram[2] == 0:
+                return None
+            rank = q * histogram[2]
+            seen = 0
+            for i, bucket in enumerate(histogram[0]):
+                seen += bucket
+                if seen >= rank:
+                    return self.BUCKETS[i] if i < len(self.BUCKETS) else float("inf")
+        return None
+
+    def prometheus_text(self):
+        lines = []
+        with self.lock:
+            histograms = {stage: (list(histogram[0]), histogram[1], histogram[2]) for stage, histogram in self.histograms.items()}
+            counters = dict(self.counters)
+        lines.append("# HELP tesla_stage_duration_seconds Time spent in each stage of our work")
+        lines.append("# TYPE tesla_stage_duration_seconds histogram")
+        for stage, (buckets, total, count) in sorted(histograms.items()):
+            cumulative = 0
+            for i, bucket in enumerate(buckets):
+                cumulative += bucket
+                le = str(self.BUCKETS[i]) if i < len(self.BUCKETS) else "+Inf"
+                lines.append('tesla_stage_duration_seconds_bucket{stage="' + stage + '",le="' + le + '"} ' + str(cumulative))
+            lines.append('tesla_stage_duration_seconds_sum{stage="' + stage + '"} ' + repr(total))
+            lines.append('tesla_stage_duration_seconds_count{stage="' + stage + '"} ' + str(count))
+        for name in sorted(set(name for name, labels in counters)):
+            lines.append("# TYPE " + name + " counter")
+            for (counter, labels), value in sorted(counters.items()):
+                if counter == name:
+                    lines.append(name + "{" + ",".join(label + '="' + str(label_value) + '"' for label, label_value in labels) + "} " + str(value))
+        gauges = self.gauge_values()
+        for name in sorted(set(name for name, labels in gauges)):
+            lines.append("# TYPE " + name + " gauge")
+            for (gauge, labels), value in sorted(gauges.items()):
+                if gauge == name:
+                    lines.append(name + "{" + ",".join(label + '="' + str(label_value) + '"' for label, label_value in labels) + "} " + str(value))
+        return "\n".join(lines) + "\n"
+
+    # Short version for our MQTT metrics topic
+    def summary(self):
+        with self.lock:
+            stages = list(self.histograms.keys())
+            counters = dict(self.counters)
+        summary = {"stages": {}, "counters": {}}
+        for stage in stages:
+            with self.lock:
+                total, count = self.histograms[stage][1], self.histograms[stage][2]
+            summary["stages"][stage] = {"count": count, "avg": round(total / count, 4), "p50": self.quantile(stage, 0.5), "p99": self.quantile(stage, 0.99)}
+        for (name, labels), value in counters.items():
+            summary["counters"][name + "".join("," + label + "=" + str(label_value) for label, label_value in labels)] = value
+        for (name, labels), value in self.gauge_values().items():
+            summary["counters"][name + "".join("," + label + "=" + str(label_value) for label, label_value in labels)] = value
+        return summary
+
+class MetricsSpan:
+    def __init__(self, metrics, stage):
+        self.metrics = metrics
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.metrics.observe(self.stage, time.monotonic() - self.start)
+        if exc_type is not None:
+            self.metrics.count("tesla_errors_total", stage=self.stage)
+        return False
+
+# Answers any HTTP request on our metrics port with the Prometheus text
+async def serve_metrics(reader, writer):
+    try:
+        while (await reader.readline()) not in (b"\r\n", b"\n", b""): # We don't care about the request
+            pass
+        body = g_metrics.prometheus_text().encode("utf-8")
+        writer.write(b"HTTP/1.0 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\nContent-Length: " + str(len(body)).encode() + b"\r\n\r\n" + body)
+        await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+
+# Publishes a summary of our metrics on our MQTT metrics topic every 'interval' seconds
+async def metrics_loop(client, topic, interval):
+    while True:
+        await asyncio.sleep(interval)
+        client.publish(topic, json.dumps(g_metrics.summary()))
+
+# Class used to record what we receive (MQTT packets, Tessie and OWM answers) and the emails we send, one json line per event
+# with its time, so replay_tesla_windows.py can play them back. Secrets (OWM's appid) are removed. Files ending in .gz are
+# written as a complete gzip member every 'batch' seconds so a killed process or a restart never leaves a broken file
+class Recorder:
+    def __init__(self, filename, batch=30):
+        self.filename = filename
+        self.compress = filename.endswith(".gz")
+        self.batch = batch
+        self.lock = Lock()
+        self.lines = []
+        self.written = time.monotonic()
+        self.file = open(filename, "ab")
+        atexit.register(self.flush)
+
+    def record(self, kind, **fields):
+        fields["t"] = round(time.time(), 3)
+        fields["kind"] = kind
+        if "url" in fields:
+            fields["url"] = redact_url(fields["url"])
+        line = json.dumps(fields, separators=(",", ":")) + "\n"
+        with self.lock:
+            self.lines.append(line)
+            if not self.compress or time.monotonic() - self.written >= self.batch:
+                self.write()
+
+    def flush(self):
+        with self.lock:
+            self.write()
+
+    def write(self):
+        if len(self.lines) > 0:
+            data = "".join(self.lines).encode("utf-8")
+            self.file.write(gzip.compress(data) if self.compress else data)
+            self.file.flush()
+            self.lines = []
+        self.written = time.monotonic()
+
+# Removes the secrets from an URL before it's logged or recorded
+def redact_url(url):
+    parts = urlsplit(url)
+    query = "&".join(param for param in parts.query.split("&") if not param.startswith("appid="))
+    return parts.path + ("?" + query if query else "")
 
 def printWithTime(text):
     now = datetime.now()
     current_time = now.strftime("%H:%M:%S")
     print(current_time + " : " + text)
 
+# Writes 'text' to 'filename' through a temporary file so a crash or a full disk never leaves it half written
+def write_atomically(filename, text):
+    with open(filename + ".tmp", "w") as f:
+        f.write(text)
+    os.replace(filename + ".tmp", filename)
+
+# What the supervisor, the state file and our debug reports read of our shared state. Never changed, replaced as a whole
+CoreView = namedtuple("CoreView", "mqtt_last_run timer_last_run already_sent_email_after_error mqtt_dropped ready")
+
+# Class used to own the state shared by our tasks and the Tessie and OWM worker threads. It only changes through events applied
+# one at a time on our event loop: applied right away when posted from the loop, queued on it with call_soon_threadsafe when
+# posted from another thread. Each event replaces 'view' with a new CoreView so readers never need a lock and never see half an
+# update. Stations and vehicles keep their own state, which is only changed from the loop
+class Core:
+    def __init__(self):
+        now = datetime.now()
+        self.view = CoreView(now, now, False, 0, False)
+        self.subscribing = set() # Message ids of our station subscriptions the broker hasn't acknowledged yet
+        self.loop = None
+        self.thread = None
+
+    # Called from the loop once it runs. Until then, events are applied right away
+    def start(self, loop):
+        self.loop = loop
+        self.thread = get_ident()
+
+    # Returns what the event's handler returned, or None when it was queued for the loop
+    def post(self, event, **fields):
+        if self.loop is not None and get_ident() != self.thread:
+            self.loop.call_soon_threadsafe(self.apply, event, fields)
+            return None
+        return self.apply(event, fields)
+
+    def apply(self, event, fields):
+        return getattr(self, "on_" + event)(**fields)
+
+    def update(self, **changes):
+        self.view = self.view._replace(**changes)
+
+    # A packet came in on one of our topics. Only our stations tell the supervisor MQTT is alive, pushed vehicle states come and go
+    def on_mqtt_packet(self, received, station, dropped):
+        changes = {}
+        if station:
+            changes["mqtt_last_run"] = received
+        if dropped:
+            changes["mqtt_dropped"] = self.view.mqtt_dropped + 1
+        self.update(**changes)
+
+    # Give a new MQTT connection time to get the station's packets
+    def on_mqtt_reconnect(self):
+        self.update(mqtt_last_run=datetime.now())
+
+    def on_subscribing(self, mid):
+        self.subscribing.add(mid)
+
+    # Returns True once the broker acknowledged all our stations
+    def on_subscribed(self, mid):
+        self.subscribing.discard(mid)
+        return len(self.subscribing) == 0
+
+    def on_tick(self, now):
+        self.update(timer_last_run=now)
+
+    # Returns True if we haven't sent an email about an error yet, so the caller sends that one
+    def on_error(self):
+        if self.view.already_sent_email_after_error:
+            return False
+        self.update(already_sent_email_after_error=True)
+        return True
+
+    # MQTT connected or a timer run finished in time, the next error gets its email again
+    def on_recovered(self):
+        if self.view.already_sent_email_after_error:
+            self.update(already_sent_email_after_error=False)
+
+    # Returns True the first time only
+    def on_ready(self):
+        if self.view.ready:
+            return False
+        self.update(ready=True)
+        return True
+
 # The MQTT callback for when the client receives a CONNACK response from the server.
 def on_mqtt_connect(client, userdata, flags, rc):
     printWithTime("Tesla-MQTT: Connected to MQTT with result code " + str(rc))
     # Subscribing in on_connect() means that if we lose the connection and
     # reconnect then subscriptions will be renewed.
-    client.subscribe("acurite/loop")
+    for topic in g_stations_by_topic:
+        result, mid = client.subscribe(topic)
+        g_core.post("subscribing", mid=mid)
+    if g_push_topic is not None:
+        client.subscribe(g_push_topic)
+
+# Once the broker acknowledged all our stations, rain monitoring is live
+def on_mqtt_subscribe(client, userdata, mid, granted_qos):
+    if g_core.post("subscribed", mid=mid):
+        if g_core.view.ready: # Back after losing the broker
+            sd_notify("STATUS=Watching for rain with MQTT")
+        report_ready("MQTT")
 
 # The MQTT callback for when a PUBLISH message is received from the server.
+# Called from paho's network handling, so only queue the raw packet and let mqtt_consumer() do the work. That way
+# keepalives and the station's packets keep flowing even when Tessie takes its time to answer
 def on_mqtt_message(client, userdata, msg):
-    global g_mqtt_raining
-    global g_mqtt_lastRun
-    global g_mqtt_ran
-    global g_out_temp
-    global g_own_raining
-    global g_kill_prog
-    
-    g_mqtt_lastRun = datetime.now()
-    g_mqtt_ran = True
+    received = datetime.now()
+
+    dropped = g_mqtt_queue.full()
+    if dropped: # We're falling behind, the oldest packet is the least useful one
+        g_mqtt_queue.get_nowait()
+    g_core.post("mqtt_packet", received=received, station=msg.topic in g_stations_by_topic, dropped=dropped)
+
+    g_mqtt_queue.put_nowait((msg.topic, msg.payload, received))
+
+    if g_recorder is not None:
+        g_recorder.record("mqtt", topic=msg.topic, payload=msg.payload.decode('utf-8', 'replace'))
+
+# Empties the MQTT queue in bursts, adding every reading to its station's rolling windows and only then looking at each station
+# once. Hands the stations that just started raining to rain_worker(). Supervised as 'ingest'
+async def mqtt_consumer():
+    while True:
+        packets = [await g_mqtt_queue.get()]
+        while not g_mqtt_queue.empty():
+            packets.append(g_mqtt_queue.get_nowait())
+
+        readings = {} # Station -> when we last heard from it in that burst
+        pushes = {}
+        for topic, payload, received in packets:
+            if g_debug & 0x10:
+                printWithTime(topic + " " + str(payload.decode('utf-8')))
+
+            if topic == g_push_topic:
+                vehicle, snapshot = decode_push(payload)
+                if vehicle is not None:
+                    pushes[vehicle] = snapshot # Only the latest state of each vehicle matters
+                continue
+
+            station = g_stations_by_topic.get(topic)
+            if station is None:
+                continue
 
-    if g_kill_prog == True:
-        printWithTime("Tesla-MQTT: Asked to quit")
-        quit(1) # Quit so systemctl respawn the process because we were asked to quit. Not elegant but does the work
+            try:
+                jsondata = json.loads(str(payload.decode('utf-8')))
+                rain_cm = jsondata.get('rain_cm')
+                out_temp = jsondata.get('outTemp_C')
+                rain = float(rain_cm) if rain_cm is not None else 0.0
+                out_temp = float(out_temp) if out_temp is not None else None
+            except (ValueError, AttributeError, TypeError) as error:
+                printWithTime("Tesla-MQTT: Skipping bad packet from '" + station.name + "': " + str(error))
+                continue
+
+            if g_debug & 8: # Force rain
+                rain = 0.01	# DEBUG To test the code when it rains
+
+            station.add(received.timestamp(), rain, out_temp)
+            readings[station] = received
+
+        if (g_debug & 3) > 2 and len(packets) > 1:
+            printWithTime("Tesla-MQTT: Debug: Coalesced " + str(len(packets)) + " packets into " + str(len(readings) + len(pushes)) + " readings")
+
+        for vehicle, snapshot in pushes.items():
+            on_push(vehicle, snapshot)
+
+        for station, received in readings.items():
+            was_raining = station.raining
+            started = station.update(received.timestamp()) # Only goes back to False once the rain has stopped, so we don't keep pounding the vehicle for the same rain shower
+            station.last_reading = received
+
+            # How much rain has fallen lately
+            if (g_debug & 3) > 2:
+                printWithTime("Tesla-MQTT: Debug: {:.4f}".format(station.rain) + " cm, {:.2f}".format(station.rate) + " cm/h")
+            elif (g_debug & 3) > 1 and station.rain > 0.0:
+                printWithTime("Tesla-MQTT: Debug: {:.4f}".format(station.rain) + " cm, {:.2f}".format(station.rate) + " cm/h")
+
+            if started:
+                if g_rain_queue.full():
+                    printWithTime("Tesla-MQTT: Still busy with previous rain, skipping station '" + station.name + "'")
+                else:
+                    g_rain_queue.put_nowait((station, station.rain))
+            elif station.raining:
+                if (g_debug & 3) > 0:
+                    printWithTime("Tesla-MQTT: Skipping, waiting for the rain to stop")
+            elif was_raining:
+                if (g_debug & 3) > 0:
+                    printWithTime("Tesla-MQTT: Rain has stopped at station '" + station.name + "'")
+            elif station.rain > 0.0:
+                if (g_debug & 3) > 1:
+                    printWithTime("Tesla-MQTT: Debug: Not enough rain yet at station '" + station.name + "' to call it raining")
+            else:
+                if g_debug & 4:
+                    printWithTime("Tesla-MQTT Debug: All is fine")
 
+        if g_state is not None:
+            g_state.checkpoint() # Only writes if a station started or stopped raining
 
-    if g_debug & 0x10:
-        printWithTime(msg.topic + " " + str(msg.payload.decode('utf-8')))
+# Checks the windows of the vehicles near a station that just started raining, one rain transition at a time. Supervised as 'rain'
+async def rain_worker():
+    while True:
+        station, rain = await g_rain_queue.get()
 
-    jsondata = json.loads(str(msg.payload.decode('utf-8')))
-    rain_cm = jsondata.get('rain_cm')
-    
-    if g_debug & 8: # Force rain
-        rain_cm = "0.01"	# DEBUG To test the code when it rains
+        if (g_debug & 3) > 1:
+            printWithTime("Tesla-MQTT: Debug: Calling raining_check_windows for station '" + station.name + "'")
+
+        checks = []
+        for vehicle in g_vehicles:
+            if vehicle.owm_raining == True: # OWM has already seen rain where that vehicle is
+                continue
+            position = vehicle.snapshots.last_position()
+            if position is not None and not station.fence.contains(position[0], position[1]): # Last time we saw it, it was parked too far from that station
+                if (g_debug & 3) > 1:
+                    printWithTime("Tesla-MQTT: Debug: VIN " + vehicle.vin + " is out of range of station '" + station.name + "'")
+                continue
+            checks.append(in_fleet_slot(raining_check_windows(vehicle, rain, "", station))) # It's raining according to MQTT, let's check our windows
+            vehicle.next_poll = 0.0 # And have the timer take a full look at it right away
+        if len(checks) > 0:
+            g_poll_now.set()
+
+        with g_supervisor.busy("rain"):
+            results = await asyncio.gather(*checks, return_exceptions = True)
+        for result in results:
+            if isinstance(result, Exception):
+                printWithTime("Tesla-MQTT: Checking windows failed: " + repr(result))
+
+        if g_state is not None:
+            g_state.checkpoint()
+
+# Builds a snapshot from a vehicle state pushed on our push topic. The payload is shaped like Tessie's 'state' answer (with its 'vin'
+# and 'state' fields) and can have a 'status' field like Tessie's 'status' answer. Returns (None, None) if it isn't usable
+def decode_push(payload):
+    try:
+        state = json.loads(str(payload.decode('utf-8')))
+    except ValueError as error:
+        printWithTime("Tesla-Push: Skipping bad vehicle state: " + str(error))
+        return None, None
+    if not isinstance(state, dict):
+        return None, None
+
+    vin = state.get("vin")
+    if vin is None and len(g_vehicles) == 1:
+        vehicle = g_vehicles[0]
+    else:
+        vehicle = g_vehicles_by_vin.get(vin)
+    if vehicle is None:
+        if (g_debug & 3) > 0:
+            printWithTime("Tesla-Push: Skipping vehicle state of unknown VIN " + str(vin))
+        return None, None
 
-    if "outTemp_C" in jsondata:
-        g_out_temp = float(jsondata.get('outTemp_C'))
+    status = state.get("status")
+    if status is None:
+        status = "awake" if state.get("state") == "online" else state.get("state")
 
-    # Read how much rain as fallen
-    if rain_cm is not None:
-        rain = float(rain_cm)
-    else:
-        rain = 0.0
+    # Pushed states come from a bridge we don't control, a missing or null field shouldn't take the consumer down
+    try:
+        snapshot = VehicleSnapshot(status, 200, state)
+        snapshot.position()
+    except (KeyError, TypeError, ValueError) as error:
+        printWithTime("Tesla-Push: Skipping bad vehicle state for VIN " + vehicle.vin + ": " + type(error).__name__ + " " + str(error))
+        return None, None
+    if not snapshot.complete:
+        if (g_debug & 3) > 0:
+            printWithTime("Tesla-Push: Skipping incomplete vehicle state for VIN " + vehicle.vin)
+        return None, None
+    return vehicle, snapshot
 
-    if (g_debug & 3) > 2:
-        printWithTime("Tesla-MQTT: Debug: {:.4f}".format(rain) + " cm")
-    elif (g_debug & 3) > 1 and rain > 0.0:
-        printWithTime("Tesla-MQTT: Debug: {:.4f}".format(rain) + " cm")
+# A vehicle pushed its state. Keep it instead of asking Tessie and if something we act on changed, have the timer look at it now
+def on_push(vehicle, snapshot):
+    previous = vehicle.snapshots.snapshot
+    vehicle.snapshots.push(snapshot, g_push_poll)
 
-    if rain > 0.0:
-        if g_mqtt_raining == False and g_owm_raining == False:    # We'll reset to False once the rain has stopped, so we don't keep pounding the vehicle for the same rain shower
-            g_mqtt_raining = True 
-            if (g_debug & 3) > 1:
-                printWithTime("Tesla-MQTT: Debug: Calling raining_check_windows")
-            raining_check_windows(rain, "") # It's raining according to MQTT, let's check our windows (and OWM hasn't seen rain yet)
-            if (g_debug & 3) > 1:
-                printWithTime("Tesla-MQTT: Debug: Returning from raining_check_windows")
-        else:
-            if (g_debug & 3) > 0:
-                printWithTime("Tesla-MQTT: Skipping, waiting for the rain to stop")
-    else:
-        g_mqtt_raining = False
-        if g_debug & 4:
-            printWithTime("Tesla-MQTT Debug: All is fine")
+    if previous is not None and previous.status == snapshot.status and previous.windows == snapshot.windows and previous.shift_state == snapshot.shift_state and previous.position() == snapshot.position():
+        return
 
-def tessie(command, extra, timeout):
+    if (g_debug & 3) > 1:
+        printWithTime("Tesla-Push: Debug: VIN " + vehicle.vin + " changed to " + repr(snapshot))
+
+    vehicle.next_poll = 0.0
+    g_poll_now.set()
+
+    # Windows opened or parked where it's already raining
+    position = snapshot.position()
+    if snapshot.parked() and snapshot.windows_opened() and position is not None:
+        station = g_station_index.nearest(position[0], position[1])
+        if station_covers(station, position[0], position[1]) and station.raining:
+            run_task(in_fleet_slot(raining_check_windows(vehicle, station.rain, "", station)))
+
+# Runs a coroutine in the background, keeping a reference to it until it's done so it isn't garbage collected
+def run_task(coro):
+    task = asyncio.ensure_future(coro)
+    g_tasks.add(task)
+    task.add_done_callback(g_tasks.discard)
+    return task
+
+# Name of the stage each Tessie command is timed as
+TESSIE_STAGES = {"status": "tessie_status", "state": "tessie_state", "command/close_windows": "close_windows"}
+
+# An 'urgent' call is part of closing the windows and can use what's kept in reserve in Tessie's budget
+def tessie(vehicle, command, extra, timeout, urgent=False):
     global g_t_sec
-    global g_timeout_count
-    global g_kill_prog
     
-    url = "https://api.tessie.com/" + vin + "/" + command + extra
+    url = tessie_url + "/" + vehicle.vin + "/" + command + extra
     headers = {
         "accept": "application/json",
-        "authorization": "Bearer " + tessie_token
+        "authorization": "Bearer " + vehicle.token
     }
 
     if g_debug & 0x20:
         printWithTime("url=" + url)
         printWithTime(json.dumps(headers, indent = 4))
 
+    stage = TESSIE_STAGES.get(command, "tessie_" + command.replace("/", "_"))
     try:
-        response = requests.get(url, headers=headers, timeout=timeout)
+        with g_metrics.span(stage):
+            response = g_http.get(url, "tessie", headers=headers, timeout=timeout, urgent=urgent)
+    except BudgetExhausted:
+        import requests
+        response = requests.Response()
+        response.status_code = -429
+    except CircuitOpen: # Tessie isn't answering, don't wait on it. Its circuit breaker already told about it
+        import requests
+        response = requests.Response()
+        response.status_code = -300
     except Exception as error:
-        # if we get three errors in a row, send an email
-        g_timeout_count += 1
-        if g_timeout_count == 3:
-            g_timeout_count = 0
-
-            emailBody = "Tesla-Tessie: command failed with exception: " + str(error)
-            emailSubject = "Tesla-Tessie: command failed with exception: " + type(error).__name__
-
-            try:
-                sender = Emailer()
-                sender.sendmail(sendTo, emailSubject, emailBody)
-            except Exception as error:
-                # Something is really wrong if this fails too so quit
-                if (g_debug & 3) > 0:
-                    printWithTime("Tesla-Tessie: Unable to send email because of exception: " + type(error).__name__)
-                g_kill_prog = True
-                quit(1) # Quit so systemctl respawn the process because we were asked to quit. Not elegant but does the work
-
+        g_metrics.count("tesla_api_calls_total", api="tessie", command=command)
         if (g_debug & 3) > 0:
             printWithTime("Tesla-Tessie: Command failed with exception: " + str(error))
 
+        import requests
         response = requests.Response() # Build a new Response dict
         response.status_code = -300        
     else:
-        g_timeout_count = 0
+        g_metrics.count("tesla_api_calls_total", api="tessie", command=command)
+        if response.status_code != 200:
+            g_metrics.count("tesla_errors_total", stage=stage)
     
     if g_debug & 0x40:
         printWithTime(response.status_code)
@@ -170,8 +939,8 @@ def tessie(command, extra, timeout):
 
     return response
 
-def get_vehicle_status():
-    response = tessie("status", "", g_t_sec)
+def get_vehicle_status(vehicle, urgent=False):
+    response = tessie(vehicle, "status", "", g_t_sec, urgent)
     if g_debug & 0x80:
         printWithTime(response.status_code)
         printWithTime(response.json())
@@ -181,104 +950,264 @@ def get_vehicle_status():
     else:
         return str(response.status_code)
         
-def raining_check_windows(rain, owm_station):
-    global g_windows
-    global g_moving
-    global g_longitude
-    global g_latitude
-    global g_wd_timer
-    
-    # Get the state of the vehicle first
-    vehicle_status = get_vehicle_status()
+# What we read from the vehicle at a given time. Only the fields our decisions need are kept so the large 'state' json
+# can be freed as soon as the snapshot is built
+class VehicleSnapshot:
+    __slots__ = ("status", "status_code", "complete", "windows", "shift_state", "latitude", "longitude",
+                 "outside_temp", "inside_temp", "active_cooling", "battery_level", "time")
+
+    def __init__(self, status, status_code, state=None):
+        self.status = status           # Result of get_vehicle_status()
+        self.status_code = status_code # Status code of the 'state' request
+        self.complete = False          # False if the request failed or some of the state sections were missing
+        self.windows = None            # Sum of the four windows, 0 means they are all closed
+        self.shift_state = None
+        self.latitude = None
+        self.longitude = None
+        self.outside_temp = None
+        self.inside_temp = None
+        self.active_cooling = None
+        self.battery_level = None
+        self.time = time.monotonic()
+
+        if state is None:
+            return
 
-    # Read data that I need from the vehicle
-    response = tessie("state", "?use_cache=true", g_t_sec)
-    if response.status_code != 200:
-        if response.status_code != -300:
-            if g_already_sent_email_after_error == False:
-                g_already_sent_email_after_error = True
+        vehicle_state = state.get("vehicle_state")
+        climate_state = state.get("climate_state")
+        charge_state  = state.get("charge_state")
+        drive_state   = state.get("drive_state")
+        if vehicle_state == None or drive_state == None or climate_state == None or charge_state == None:
+            return
 
-                emailBody = "Error #" + str(response.status_code) + " getting vehicle data for VIN " + vin
+        self.complete = True
+        self.windows = int(vehicle_state['fd_window']) + int(vehicle_state['fp_window']) + int(vehicle_state['rd_window']) + int(vehicle_state['rp_window']) # 0 means close so when we add them up, anything but 0 means at least a window is opened
+        self.shift_state = drive_state.get('shift_state')
+        self.latitude = drive_state.get('latitude')
+        self.longitude = drive_state.get('longitude')
+        self.outside_temp = climate_state.get('outside_temp')
+        self.inside_temp = climate_state.get('inside_temp')
+        self.active_cooling = climate_state.get('cabin_overheat_protection_actively_cooling')
+        self.battery_level = charge_state.get('battery_level')
+
+    def parked(self):
+        return self.shift_state is None or self.shift_state == "P"
+
+    def windows_opened(self):
+        return self.windows is not None and self.windows > 0
+
+    # Where the vehicle is, or None if it's not reporting its position
+    def position(self):
+        if self.latitude is None or self.longitude is None:
+            return None
+        return (float(self.latitude), float(self.longitude))
+
+    def __repr__(self):
+        return "VehicleSnapshot(" + ", ".join(name + "=" + str(getattr(self, name)) for name in self.__slots__) + ")"
+
+    # For our state file. 'time' is monotonic so it's not saved, the state file keeps the snapshot's age instead
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__ if name != "time"}
+
+    @staticmethod
+    def from_dict(saved, age):
+        snapshot = VehicleSnapshot(saved.get("status"), saved.get("status_code"))
+        for name in VehicleSnapshot.__slots__:
+            if name != "time" and name in saved:
+                setattr(snapshot, name, saved[name])
+        snapshot.time = time.monotonic() - age
+        return snapshot
+
+def read_vehicle_state(vehicle, urgent=False):
+    response = tessie(vehicle, "state", "?use_cache=true", g_t_sec, urgent)
+    if response.status_code == 200:
+        return VehicleSnapshot(None, 200, response.json())
+    return VehicleSnapshot(None, response.status_code)
+
+# Status and state are independent so ask Tessie for both at the same time
+async def fetch_vehicle_snapshot(vehicle, urgent=False):
+    vehicle_status, snapshot = await asyncio.gather(asyncio.to_thread(get_vehicle_status, vehicle, urgent), asyncio.to_thread(read_vehicle_state, vehicle, urgent))
+    snapshot.status = vehicle_status
+    return snapshot
+
+# Class used to share one vehicle snapshot between the timer and the rain checks. Fresh snapshots are reused for 'ttl' seconds
+# and if a fetch is already in progress, other callers wait for its result instead of sending their own requests to Tessie
+class SnapshotCache:
+    def __init__(self, vehicle, ttl):
+        self.vehicle = vehicle
+        self.ttl = ttl
+        self.snapshot = None
+        self.expires = 0.0      # time.monotonic() until which 'snapshot' can be used without asking Tessie
+        self.pushed_at = None   # time.monotonic() of the last state pushed to us, None if it never was
+        self.inflight = None
+        self.inflight_urgent = False
+
+    # 'urgent' when we need it to close the windows, see tessie()
+    async def get(self, urgent=False):
+        if self.snapshot is not None and time.monotonic() < self.expires:
+            return self.snapshot
+        # An urgent caller doesn't wait on a routine read, our budget can deny that one what it would give the urgent one
+        if self.inflight is None or (urgent and not self.inflight_urgent):
+            self.inflight = asyncio.ensure_future(self.fetch(urgent))
+            self.inflight_urgent = urgent
+        return await asyncio.shield(self.inflight) # A caller giving up (timeout) mustn't cancel the fetch the others are waiting on
+
+    async def fetch(self, urgent):
+        try:
+            snapshot = await fetch_vehicle_snapshot(self.vehicle, urgent)
+        except Exception as error:
+            printWithTime("Tesla-Snapshot: Unable to read the vehicle because of exception: " + type(error).__name__)
+            snapshot = VehicleSnapshot("-300", -300)
+        finally:
+            if self.inflight is asyncio.current_task(): # An urgent read may have taken our place
+                self.inflight = None
+        if snapshot.status_code == 200: # Only cache good data so the next caller tries again
+            self.snapshot = snapshot
+            self.expires = snapshot.time + self.ttl
+        return snapshot
+
+    # Keep a snapshot that was pushed to us. It's good for 'ttl' seconds since a push only comes when something changed
+    def push(self, snapshot, ttl):
+        self.snapshot = snapshot
+        self.expires = snapshot.time + ttl
+        self.pushed_at = snapshot.time
+
+    # Where the vehicle was the last time we read it, or None
+    def last_position(self):
+        if self.snapshot is None:
+            return None
+        return self.snapshot.position()
+
+    # Forget what we know, like after sending a command that changes the vehicle's state
+    def invalidate(self):
+        self.snapshot = None
+        self.expires = 0.0
+
+# Class used to send 'close_windows' to a vehicle one at a time. Whoever asks while it's being sent waits for that answer instead
+# of sending another one, and once the vehicle said its windows are closed we don't ask again for 'cooldown' seconds, or because
+# of a snapshot read before that
+class WindowCloser:
+    def __init__(self, vehicle, cooldown):
+        self.vehicle = vehicle
+        self.cooldown = cooldown
+        self.inflight = None
+        self.closed = None      # Answer of the last close that worked
+        self.closed_at = 0.0    # time.monotonic() of that answer
+
+    # Returns Tessie's answer and whether it was shared with someone else instead of being asked for this 'snapshot'
+    async def close(self, snapshot):
+        if self.closed is not None and (time.monotonic() < self.closed_at + self.cooldown or snapshot.time <= self.closed_at):
+            g_metrics.count("tesla_close_windows_shared_total", reason="cooldown")
+            return self.closed, True
+        if self.inflight is not None:
+            g_metrics.count("tesla_close_windows_shared_total", reason="inflight")
+            return await asyncio.shield(self.inflight), True
+        self.inflight = asyncio.ensure_future(self.send())
+        return await asyncio.shield(self.inflight), False # A caller giving up mustn't cancel the command the others are waiting on
+
+    async def send(self):
+        waitTime = g_wd_timer - 5
+        if waitTime > 90:
+            waitTime = 90
+        try:
+            response = await asyncio.to_thread(tessie, self.vehicle, "command/close_windows", "?retry_duration=" + str(waitTime), waitTime, True)
+        finally:
+            self.inflight = None
+        self.vehicle.snapshots.invalidate() # Windows should now be closed, don't trust what we read before
+        if response.status_code == 200 and response.json().get("result") == True:
+            self.closed = response
+            self.closed_at = time.monotonic()
+        return response
+
+# Everything we keep about one of the vehicles we watch
+class Vehicle:
+    def __init__(self, vin, token, snapshot_ttl, close_cooldown):
+        self.vin = vin
+        self.token = token
+        self.suffix = ""            # Added to the subject of the emails about this vehicle when we watch more than one
+        self.snapshots = SnapshotCache(self, snapshot_ttl)
+        self.closer = WindowCloser(self, close_cooldown)
+        self.night = False
+        self.retry = 0
+        self.owm_raining = False
+        self.nowcast_raining = False # We already acted on the rain OWM's minutely forecast expects
+        self.already_sent_email_after_error = False
+        self.next_poll = 0.0        # time.monotonic() at which the timer should check it again
+
+# Limits how many vehicles we're talking to Tessie about at the same time
+async def in_fleet_slot(coro):
+    async with g_fleet_slots:
+        return await coro
+
+# Queues an email, never blocks
+def send_email(emailSubject, emailBody):
+    g_outbox.send(emailSubject, emailBody)
+
+async def raining_check_windows(vehicle, rain, owm_station, station=None, nowcast=None):
+    # Get the state of the vehicle first, shared with the timer if it just read it
+    snapshot = await vehicle.snapshots.get(urgent=True)
+    if snapshot.status_code != 200:
+        if snapshot.status_code == -429: # Out of budget, that's by design and not worth an email
+            g_metrics.count("tesla_checks_skipped_total", check="rain", reason="budget")
+            printWithTime("Tesla-CheckRain: Not checking windows of VIN " + vehicle.vin + ", our Tessie budget is spent")
+        elif snapshot.status_code != -300:
+            if vehicle.already_sent_email_after_error == False:
+                vehicle.already_sent_email_after_error = True
+
+                emailBody = "Error #" + str(snapshot.status_code) + " getting vehicle data for VIN " + vehicle.vin
                 emailSubject = "Tesla-CheckRain: " + emailBody
 
-                try:
-                    sender = Emailer()
-                    sender.sendmail(sendTo, emailSubject, emailBody)
-                except Exception as error:
-                    if (g_debug & 3) > 0:
-                        if rain < 0.0:
-                            printWithTime("Tesla-Timer: Unable to send email because of exception: " + type(error).__name__)
-                        else:
-                            printWithTime("Tesla-MQTT: Unable to send email because of exception: " + type(error).__name__)
+                send_email(emailSubject, emailBody)
 
                 printWithTime("Tesla-CheckRain: " + emailBody)
 
         return;
     
-    vehicle_state = response.json().get("vehicle_state")
-    climate_state = response.json().get("climate_state")
-    charge_state  = response.json().get("charge_state")
-    drive_state   = response.json().get("drive_state")
-    
-    if vehicle_state == None or drive_state == None or climate_state == None or charge_state == None:
-        if g_already_sent_email_after_error == False:
-            g_already_sent_email_after_error = True
+    if not snapshot.complete:
+        if vehicle.already_sent_email_after_error == False:
+            vehicle.already_sent_email_after_error = True
 
-            emailBody = "Missing data reading vehicle state for VIN " + vin
+            emailBody = "Missing data reading vehicle state for VIN " + vehicle.vin
             emailSubject = "Tesla-CheckRain: " + emailBody
 
-            try:
-                sender = Emailer()
-                sender.sendmail(sendTo, emailSubject, emailBody)
-            except Exception as error:
-                if (g_debug & 3) > 0:
-                    printWithTime("Tesla-CheckRain: Unable to send email because of exception: " + type(error).__name__)
+            send_email(emailSubject, emailBody)
 
             printWithTime("Tesla-CheckRain: " + emailBody)
 
         return;
 
-    g_already_sent_email_after_error = False; 
-
-    g_moving = drive_state['shift_state']
-
-    fd_window = int(vehicle_state['fd_window'])
-    fp_window = int(vehicle_state['fp_window'])
-    rd_window = int(vehicle_state['rd_window'])
-    rp_window = int(vehicle_state['rp_window'])
-    g_windows = fd_window + fp_window + rd_window + rp_window # 0 means close so when we add them up, anything but 0 means at least a window is opened
+    vehicle.already_sent_email_after_error = False; 
 
-    g_latitude  = drive_state['latitude']
-    g_longitude = drive_state['longitude']
-    
-    if g_latitude == None or g_longitude == None:
+    position = snapshot.position()
+    if position is None:
         if (g_debug & 3) > 2:
             printWithTime("Tesla-CheckRain: Debug: Missing Latitude or Longitude, assuming we're at our station")
-        latitude = station_latitude
-        longitude = station_longitude
+        if station is not None:
+            latitude = station.fence.latitude
+            longitude = station.fence.longitude
+        else:
+            latitude = station_latitude
+            longitude = station_longitude
     else:
-        latitude = g_latitude
-        longitude = g_longitude
+        latitude, longitude = position
 
     # Our windows are opened and we are parked
-    if (g_windows is not None and g_windows > 0) and (g_moving is None or g_moving == "P"):
+    if snapshot.windows_opened() and snapshot.parked():
         # Now check if we're close to our station. If not, ignore the rain
-        station = (station_latitude, station_longitude)
-        vehicle_position = (float(latitude), float(longitude))
-        distance = float(geopy.distance.geodesic(station, vehicle_position).km)
-
-        if distance < max_distance or rain < 0.0: # If we're close to our station or OWM has seen rain (uses the vehicle's location), close the windows
-            # This is where we close our windows
-            waitTime = g_wd_timer - 5
-            if waitTime > 90:
-                waitTime = 90
-            response = tessie("command/close_windows", "?retry_duration=" + str(waitTime), waitTime)
+        if rain < 0.0 or station_covers(station, latitude, longitude): # If OWM has seen rain (uses the vehicle's location) or that station is the one closest to us, close the windows
+            # This is where we close our windows, unless someone else already is
+            response, shared = await vehicle.closer.close(snapshot)
+            if shared:
+                if (g_debug & 3) > 0:
+                    printWithTime("Tesla-CheckRain: Windows of VIN " + vehicle.vin + " are already being closed or just were, status code was " + str(response.status_code))
+                return
             status_code = response.status_code
             if status_code == 200:
                 result = response.json().get("result")
-                woke = response.json().get("woke")
                 if result == True:
-                    if rain < 0.0:
+                    if nowcast is not None:
+                        emailBody = "Our windows are opened and OWM expects " + "{:.1f}".format(nowcast[1]) + " mm/h of rain in " + str(int(nowcast[0] / 60)) + " minutes! Closing them before it starts"
+                    elif rain < 0.0:
                         emailBody = "Our windows are opened and it's raining according to the closest OWM station (" + owm_station + ")! Closing them"
                     else:
                         emailBody = "We're parked close enough to our station with our windows opened in the rain! Closing them"
@@ -292,334 +1221,1027 @@ def raining_check_windows(rain, owm_station):
                 else:
                     emailSubject = "Tesla-MQTT: " + emailBody
         else:
+            distance = station.fence.distance(float(latitude), float(longitude))
             emailBody = "We're parked with our windows opened in the rain but too far (" + "%.1f" % distance + " km) to be sure it's raining on us, so leaving as is"
 
         now = datetime.now()
         current_time = now.strftime("%H:%M:%S")
-        if rain < 0.0:
-            emailSubject = "Tesla-CheckRain: It has rained according to OWM station '" + owm_station + "' at " + current_time
+        if nowcast is not None:
+            emailSubject = "Tesla-CheckRain: Rain expected by OWM's forecast at " + current_time + vehicle.suffix
+        elif rain < 0.0:
+            emailSubject = "Tesla-CheckRain: It has rained according to OWM station '" + owm_station + "' at " + current_time + vehicle.suffix
         else:
-            emailSubject = "Tesla-CheckRain: It has rained " + str(rain) + " cm at " + current_time
+            emailSubject = "Tesla-CheckRain: It has rained " + str(rain) + " cm at " + current_time + station.suffix + vehicle.suffix
 
-        try:
-            sender = Emailer()
-            sender.sendmail(sendTo, emailSubject, emailBody)
-        except Exception as error:
-            if (g_debug & 3) > 0:
-                printWithTime("Tesla-CheckRain: Unable to send email because of exception: " + type(error).__name__)
+        send_email(emailSubject, emailBody)
     
         printWithTime(emailSubject)
         printWithTime("Tesla-CheckRain: " + emailBody)
     else:
-        if rain < 0.0:
+        if nowcast is not None:
+            if (g_debug & 3) > 0:
+                printWithTime("Tesla-CheckRain: OWM expects rain but our windows are closed or the vehicle is moving")
+        elif rain < 0.0:
             if (g_debug & 3) > 0:
-                if (g_moving is None or g_moving == "P"):
+                if snapshot.parked():
                     printWithTime("Tesla-CheckRain: It has rained according to OWM and our windows are closed")
                 else:
                     printWithTime("Tesla-CheckRain: It has rained according to OWM but the vehicle is moving")
         else:
             if (g_debug & 3) > 0:
-                if (g_moving is None or g_moving == "P"):
+                if snapshot.parked():
                     printWithTime("Tesla-CheckRain: It has rained " + str(rain) + " cm and our windows are closed")
                 else:
                     printWithTime("Tesla-CheckRain: It has rained " + str(rain) + " cm but the vehicle is moving")
 
     return
     
-class RepeatTimer(Timer):
-    global g_kill_prog
-
-    def run(self):
-        while not self.finished.wait(self.interval):
-            if g_kill_prog == True:
-                printWithTime("Tesla-RepeatTimer: Asked to quit")
-                quit(1) # Quit so systemctl respawn the process because we were asked to quit. Not elegant but does the work
+# Class used to remember today's sunrise and sunset and tomorrow's sunrise. They are only computed again when the local date
+# changes or when the vehicle moves to another cell of 'cell_size' degrees (the sun times barely move within a cell)
+class Ephemeris:
+    def __init__(self, timezone, cell_size):
+        self.timezone = timezone
+        self.cell_size = cell_size
+        self.key = None
+        self.today_sr = None
+        self.today_ss = None
+        self.tomorrow_sr = None
+
+    def get(self, now_tz, latitude, longitude):
+        cell = (round(float(latitude) / self.cell_size), round(float(longitude) / self.cell_size))
+        today = now_tz.date()
+        if self.key != (today, cell):
+            from suntime import Sun
+            sun = Sun(cell[0] * self.cell_size, cell[1] * self.cell_size) # Use the center of the cell so every position in it gets the same times
+            self.today_sr = sun.get_sunrise_time(today)
+            self.today_ss = sun.get_sunset_time(today)
+            if self.today_sr > self.today_ss:
+                self.today_ss = self.today_ss + timedelta(days=1) # Bug in the routine, day isn't update when crossing over midnight in UTC timezone
+            self.tomorrow_sr = sun.get_sunrise_time(today + timedelta(days=1))
+            self.key = (today, cell)
+            if g_debug & 0x8000:
+                printWithTime("Tesla-Ephemeris: Debug: Computed sun times for " + str(today) + " in cell " + str(cell))
+
+        return self.today_sr, self.today_ss, self.tomorrow_sr
+
+# Class used to tell if a position is within 'radius' km of a point. A bounding box rejects far away positions right away and the
+# haversine distance settles the rest, except within 'margin' of the boundary where the slower but exact geopy geodesic is used
+class Geofence:
+    def __init__(self, name, latitude, longitude, radius):
+        self.name = name
+        self.latitude = float(latitude)
+        self.longitude = float(longitude)
+        self.radius = float(radius)
+        self.margin = self.radius * 0.005 + 0.01 # Haversine (spherical earth) is within 0.5% of the ellipsoidal distance
+        lat_span = math.degrees((self.radius + self.margin) / 6371.0088)
+        cos_lat = math.cos(math.radians(self.latitude))
+        if cos_lat < 0.01:
+            self.lon_span = 180.0 # Too close to the poles for the box to help
+        else:
+            self.lon_span = min(lat_span / cos_lat, 180.0)
+        self.lat_min = self.latitude - lat_span
+        self.lat_max = self.latitude + lat_span
+        self.last_position = None
+        self.last_inside = None
+
+    # Great circle distance in km
+    def distance(self, latitude, longitude):
+        lat1 = math.radians(self.latitude)
+        lat2 = math.radians(latitude)
+        dlat = lat2 - lat1
+        dlon = math.radians(longitude - self.longitude)
+        a = math.sin(dlat / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin(dlon / 2) ** 2
+        return 2 * 6371.0088 * math.asin(min(1.0, math.sqrt(a)))
+
+    def contains(self, latitude, longitude):
+        latitude = float(latitude)
+        longitude = float(longitude)
+        if self.last_position == (latitude, longitude): # A parked vehicle doesn't move, reuse our last answer
+            return self.last_inside
+
+        dlon = abs(longitude - self.longitude)
+        if dlon > 180.0:
+            dlon = 360.0 - dlon
+        if latitude < self.lat_min or latitude > self.lat_max or dlon > self.lon_span:
+            inside = False
+        else:
+            distance = self.distance(latitude, longitude)
+            if distance < self.radius - self.margin:
+                inside = True
+            elif distance > self.radius + self.margin:
+                inside = False
             else:
-                self.function(*self.args, **self.kwargs)
+                import geopy.distance # Only needed near the boundary so don't pay its import cost at startup
+                inside = float(geopy.distance.geodesic((self.latitude, self.longitude), (latitude, longitude)).km) < self.radius
+                if (g_debug & 3) > 2:
+                    printWithTime("Tesla-Geofence: Debug: Position is near the boundary of '" + self.name + "', used geodesic")
+
+        self.last_position = (latitude, longitude)
+        self.last_inside = inside
+        return inside
+
+# A weather station publishing its readings on an MQTT topic. We keep its latest reading
+class Station:
+    def __init__(self, name, topic, latitude, longitude, radius):
+        self.name = name
+        self.topic = topic
+        self.fence = Geofence(name, latitude, longitude, radius)
+        self.suffix = ""          # Added to the subject of the emails about this station when we have more than one
+        self.raining = False
+        self.rain = None          # Rain (cm) that fell in the last 'rain_window' seconds
+        self.rate = 0.0           # And that as cm per hour
+        self.out_temp = None      # Mean of the last 'temp_window' seconds
+        self.last_reading = None
+        self.hold_until = None    # Epoch time before which a 'raining' restored from our state file can't stop, our window being empty
+        self.rain_window = RollingWindow(g_rain_window, int(g_rain_window) + 1)
+        self.temp_window = RollingWindow(g_temp_window, int(g_temp_window) + 1)
+
+    # Adds a reading from the station, 'received' is its epoch time
+    def add(self, received, rain, out_temp):
+        self.rain_window.add(received, rain)
+        if out_temp is not None:
+            self.temp_window.add(received, out_temp)
+
+    # Works out the rain rate as of 'now' (epoch) and whether it's raining, with some hysteresis so a single tip of the bucket or
+    # a rate hovering around our threshold doesn't flip it back and forth. Returns True if it just started raining
+    def update(self, now):
+        self.rain = self.rain_window.sum(now)
+        self.rate = self.rain * 3600.0 / self.rain_window.span
+        self.out_temp = self.temp_window.mean(now)
+
+        if self.raining:
+            if self.rate <= g_rain_stop and (self.hold_until is None or now >= self.hold_until):
+                self.raining = False
+            return False
+        if self.rain > 0.0 and self.rate >= g_rain_start:
+            self.raining = True
+            return True
+        return False
+
+# Class used to keep the readings of the last 'span' seconds in preallocated arrays used as a ring, with their running sum. Once
+# 'capacity' readings are kept, the oldest one makes room. Adding a reading or asking for the sum doesn't depend on how many we
+# keep and the memory used stays the same however long we run
+class RollingWindow:
+    def __init__(self, span, capacity):
+        self.span = span
+        self.times = array('d', bytes(8 * capacity))
+        self.values = array('d', bytes(8 * capacity))
+        self.first = 0
+        self.count = 0
+        self.total = 0.0
+
+    def add(self, when, value):
+        self.expire(when)
+        if self.count == len(self.times):
+            self.drop()
+        last = (self.first + self.count) % len(self.times)
+        self.times[last] = when
+        self.values[last] = value
+        self.total += value
+        self.count += 1
+
+    def drop(self):
+        self.total -= self.values[self.first]
+        self.first = (self.first + 1) % len(self.times)
+        self.count -= 1
+
+    # Forgets the readings older than 'span' seconds before 'now'. Each reading is only forgotten once
+    def expire(self, now):
+        while self.count > 0 and self.times[self.first] <= now - self.span:
+            self.drop()
+        if self.count == 0:
+            self.total = 0.0 # Don't let rounding errors add up
+
+    def sum(self, now):
+        self.expire(now)
+        return self.total
+
+    def mean(self, now):
+        self.expire(now)
+        if self.count == 0:
+            return None
+        return self.total / self.count
+
+# Grid of 'cell_size' degrees used to find the closest station to a position by only looking at the cells around it
+class StationIndex:
+    def __init__(self, stations, cell_size):
+        self.cell_size = cell_size
+        self.cells = {}
+        for station in stations:
+            self.cells.setdefault(self.cell(station.fence.latitude, station.fence.longitude), []).append(station)
+        if len(self.cells) > 0:
+            self.i_min = min(i for i, j in self.cells)
+            self.i_max = max(i for i, j in self.cells)
+            self.j_min = min(j for i, j in self.cells)
+            self.j_max = max(j for i, j in self.cells)
+
+    def cell(self, latitude, longitude):
+        return (math.floor(latitude / self.cell_size), math.floor(longitude / self.cell_size))
+
+    # Returns the closest station, or None if we don't have any
+    def nearest(self, latitude, longitude):
+        if len(self.cells) == 0:
+            return None
+        latitude = float(latitude)
+        longitude = float(longitude)
+        ci, cj = self.cell(latitude, longitude)
+        last_ring = max(abs(ci - self.i_min), abs(ci - self.i_max), abs(cj - self.j_min), abs(cj - self.j_max)) # Past that, there are no stations
+        best = None
+        best_distance = None
+        for ring in range(last_ring + 1):
+            if best is not None:
+                # Cells in this ring are at least (ring - 1) cells away, a cell being narrowest at the highest latitude of the ring
+                cos_lat = max(math.cos(math.radians(min(90.0, abs(latitude) + ring * self.cell_size))), 0.01)
+                if (ring - 1) * self.cell_size * 111.19 * cos_lat > best_distance:
+                    break
+            for i in range(ci - ring, ci + ring + 1):
+                for j in range(cj - ring, cj + ring + 1):
+                    if ring > 0 and abs(i - ci) != ring and abs(j - cj) != ring:
+                        continue # Only the border of the square, the inside was done in the previous rings
+                    for station in self.cells.get((i, j), ()):
+                        distance = station.fence.distance(latitude, longitude)
+                        if best is None or distance < best_distance:
+                            best = station
+                            best_distance = distance
+        return best
+
+# True if 'station' is the closest station to that position and the position is within its range
+def station_covers(station, latitude, longitude):
+    with g_metrics.span("geofence"):
+        return station is not None and g_station_index.nearest(latitude, longitude) is station and station.fence.contains(latitude, longitude)
+
+# True if the station closest to that position is in range and has seen rain
+def station_raining_near(latitude, longitude):
+    with g_metrics.span("geofence"):
+        station = g_station_index.nearest(latitude, longitude)
+        return station is not None and station.raining and station.fence.contains(latitude, longitude)
+
+# The station closest to that position if it's in range, with its mean outside temperature of the last 'temp_window' seconds.
+# (None, None) if no station covers it, (station, None) if it hasn't sent us a temperature lately
+def station_temperature(latitude, longitude):
+    with g_metrics.span("geofence"):
+        station = g_station_index.nearest(latitude, longitude)
+        if station is None or not station.fence.contains(latitude, longitude):
+            return None, None
+    return station, station.temp_window.mean(time.time())
+
+# Returns the first geofence the position is in, or None
+def find_geofence(latitude, longitude):
+    with g_metrics.span("geofence"):
+        for fence in g_geofences.values():
+            if fence.contains(latitude, longitude):
+                return fence
+        return None
+
+# Encodes a position as a geohash of 'precision' characters (5 is a cell of about 5 km x 5 km)
+def geohash(latitude, longitude, precision):
+    base32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    code = ""
+    bits = 0
+    value = 0
+    even = True
+    while len(code) < precision:
+        if even:
+            rng = lon_range
+            coord = longitude
+        else:
+            rng = lat_range
+            coord = latitude
+        mid = (rng[0] + rng[1]) / 2
+        value = value << 1
+        if coord >= mid:
+            value = value | 1
+            rng[0] = mid
+        else:
+            rng[1] = mid
+        even = not even
+        bits += 1
+        if bits == 5:
+            code += base32[value]
+            bits = 0
+            value = 0
+    return code
+
+# Class used to cache OWM answers per geohash cell. OWM stations only update about every 'refresh' seconds so an answer is kept
+# until its observation time ('dt') plus 'refresh', within 'min_age' and 'max_age' seconds from when we read it. Calls made to OWM
+# are counted per UTC day and we stop calling once 'daily_quota' is reached (0 means no limit). 'command' is the OWM API we call
+class WeatherCache:
+    def __init__(self, precision, refresh, min_age, max_age, daily_quota, filename, command="weather", path="/data/2.5/weather?"):
+        self.command = command
+        self.path = path
+        self.precision = precision
+        self.refresh = refresh
+        self.min_age = min_age
+        self.max_age = max_age
+        self.daily_quota = daily_quota
+        self.filename = filename
+        self.lock = Lock()
+        self.entries = {} # geohash -> {"expires": epoch, "data": json}
+        self.inflight = {} # geohash -> Event of the fetch in progress, so vehicles in the same cell share one call
+        self.day = None
+        self.calls = 0
+        self.hits = 0
+        self.load()
+
+    def load(self):
+        if self.filename is None or not os.path.exists(self.filename):
+            return
+        try:
+            with open(self.filename) as f:
+                saved = json.load(f)
+            self.entries = saved.get("entries", {})
+            self.day = saved.get("day")
+            self.calls = saved.get("calls", 0)
+        except Exception as error:
+            printWithTime("Tesla-OWM: Unable to read the " + self.command + " cache because of exception: " + type(error).__name__)
 
-def on_watchdog():
-    global g_skip_mqtt
-    global g_mqtt_ran
-    global g_timer_ran
-    global g_kill_prog
-    global g_wd_timer
+    def save(self):
+        if self.filename is None:
+            return
+        try:
+            now = time.time()
+            entries = {key: entry for key, entry in self.entries.items() if entry["expires"] > now}
+            write_atomically(self.filename, json.dumps({"entries": entries, "day": self.day, "calls": self.calls}))
+        except Exception as error:
+            printWithTime("Tesla-OWM: Unable to write the " + self.command + " cache because of exception: " + type(error).__name__)
+
+    def key(self, latitude, longitude):
+        return geohash(float(latitude), float(longitude), self.precision)
+
+    # Returns the status code and the json data of the weather at that position, from the cache if it's still fresh
+    def get(self, latitude, longitude):
+        key = self.key(latitude, longitude)
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry["expires"] > now:
+                self.hits += 1
+                if g_debug & 0x400:
+                    printWithTime("Tesla-OWM: Debug: Using cached " + self.command + " for " + key + " (" + str(int(entry["expires"] - now)) + " seconds left)")
+                return 200, entry["data"]
+
+            flight = self.inflight.get(key)
+            leader = flight is None
+            if leader:
+                today = time.strftime("%Y-%m-%d", time.gmtime())
+                if self.day != today:
+                    self.day = today
+                    self.calls = 0
+                if self.daily_quota > 0 and self.calls >= self.daily_quota:
+                    if (g_debug & 3) > 0:
+                        printWithTime("Tesla-OWM: Daily quota of " + str(self.daily_quota) + " " + self.command + " calls reached, not calling OWM")
+                    if entry is not None:
+                        return 200, entry["data"] # Better old data than no data
+                    return -429, None
 
-    now = datetime.now()
-    if g_skip_mqtt:
-        if (g_debug & 3) > 0:
-            printWithTime("Tesla-WD: last timer thread ran at " + g_timer_lastRun.strftime("%H:%M:%S"))
-    else:
-        if (g_debug & 3) > 0:
-            printWithTime("Tesla-WD: Last mqtt thread ran at " + g_mqtt_lastRun.strftime("%H:%M:%S") + " last timer thread ran at " + g_timer_lastRun.strftime("%H:%M:%S"))
+                flight = self.inflight[key] = Event()
+                flight.result = (-300, None)
 
-        # If our last mqtt data fetch plus g_wd_mqtt_max seconds is less than now, the mqtt hasn't received data for too long
-        if g_mqtt_lastRun + timedelta(seconds = g_wd_mqtt_max) < now:
-            if g_mqtt_ran == True:
-                g_mqtt_ran = False
+        if not leader:
+            flight.wait()
+            return flight.result
 
-                emailBody = "Last ran at " + g_mqtt_lastRun.strftime("%H:%M:%S")
-                emailSubject = "Tesla-WD: MQTT thread hasn't ran in over a minute, quitting program"
+        try:
+            flight.result = self.fetch(key, latitude, longitude, now)
+        finally:
+            with self.lock:
+                del self.inflight[key]
+            flight.set()
+        return flight.result
+
+    # Returns what we last got for that position, even if it's expired, without ever calling OWM
+    def peek(self, latitude, longitude):
+        with self.lock:
+            entry = self.entries.get(self.key(latitude, longitude))
+        if entry is None:
+            return None
+        return entry["data"]
+
+    def fetch(self, key, latitude, longitude, now):
+        URL = owm_url + self.path + "lat=" + str(latitude) + "&lon=" + str(longitude) + "&appid=" + str(owm_key)
+        if g_debug & 0x100:
+            printWithTime("OWM URL = " + URL)
 
+        try:
+            with g_metrics.span("owm"):
+                response = g_http.get(URL, "owm")
+        except BudgetExhausted:
+            return -429, None
+        except CircuitOpen:
+            return -300, None
+        except Exception as error:
+            if (g_debug & 3) > 0:
+                printWithTime("Tesla-OWM: OWM failed with exception: " + str(error))
+            response = None
+
+        # Only a request that actually went out counts against our quota
+        g_metrics.count("tesla_api_calls_total", api="owm", command=self.command)
+        with self.lock:
+            self.calls += 1
+        if response is None:
+            return -300, None
+
+        if response.status_code != 200:
+            g_metrics.count("tesla_errors_total", stage="owm")
+            return response.status_code, None
+
+        data = response.json()
+        if g_debug & 0x200:
+            printWithTime(json.dumps(data, indent = 4))
+
+        expires = data.get("dt", now) + self.refresh
+        expires = min(max(expires, now + self.min_age), now + self.max_age)
+        with self.lock:
+            self.entries[key] = {"expires": expires, "data": data}
+            self.save()
+        return 200, data
+
+    def stats_text(self):
+        return "calls today=" + str(self.calls) + " cache hits=" + str(self.hits)
+
+# Class used to keep our decisions (night, retries, rain, emails already sent), the last snapshot of each vehicle and what's left
+# of our API budgets across restarts so a respawned process picks up where it left off. Written atomically, only when something
+# changed, or at most every 10 seconds when it's only our budgets. A file older than 'max_age' seconds is ignored, except for the
+# budgets which know which day they're for
+class StateStore:
+    def __init__(self, filename, max_age):
+        self.filename = filename
+        self.max_age = max_age
+        self.lock = Lock()
+        self.written = None # What we last wrote, so we don't write the same thing again
+        self.written_at = 0.0
+        self.spent = 0      # g_budgets.spent when we last wrote
+
+    def restore(self):
+        if not os.path.exists(self.filename):
+            return
+        try:
+            with open(self.filename) as f:
+                saved = json.load(f)
+            g_budgets.restore(saved.get("budgets", {}))
+            elapsed = time.time() - saved["saved_at"]
+            if elapsed > self.max_age or elapsed < 0:
+                print("Tesla: Ignoring our saved state, it's from " + str(int(elapsed)) + " seconds ago")
+                return
+
+            for vin, state in saved.get("vehicles", {}).items():
+                vehicle = g_vehicles_by_vin.get(vin)
+                if vehicle is None:
+                    continue
+                vehicle.night = state.get("night", False)
+                vehicle.retry = state.get("retry", 0)
+                vehicle.owm_raining = state.get("owm_raining", False)
+                vehicle.nowcast_raining = state.get("nowcast_raining", False)
+                vehicle.already_sent_email_after_error = state.get("already_sent_email_after_error", False)
+                vehicle.next_poll = time.monotonic() + max(0.0, state.get("next_poll", 0.0) - elapsed)
+                if state.get("snapshot") is not None:
+                    snapshot = VehicleSnapshot.from_dict(state["snapshot"], state.get("snapshot_age", 0) + elapsed)
+                    vehicle.snapshots.snapshot = snapshot
+                    vehicle.snapshots.expires = snapshot.time + vehicle.snapshots.ttl
+            for station in g_stations:
+                state = saved.get("stations", {}).get(station.name)
+                if state is not None:
+                    station.raining = state.get("raining", False)
+                    if station.raining: # Our rain window starts empty, keep the verdict until it has refilled
+                        station.hold_until = time.time() + g_rain_window
+            print("Tesla: Restored our state from " + str(int(elapsed)) + " seconds ago")
+        except Exception as error:
+            printWithTime("Tesla: Unable to read our saved state because of exception: " + type(error).__name__ + " " + str(error))
+
+    # Saves our state if it changed since the last time. Called after anything that can change it. 'final' when we're quitting
+    def checkpoint(self, final=False):
+        state = {
+            "vehicles": {vehicle.vin: {
+                "night": vehicle.night,
+                "retry": vehicle.retry,
+                "owm_raining": vehicle.owm_raining,
+                "nowcast_raining": vehicle.nowcast_raining,
+                "already_sent_email_after_error": vehicle.already_sent_email_after_error,
+                "snapshot": None if vehicle.snapshots.snapshot is None else vehicle.snapshots.snapshot.to_dict()
+            } for vehicle in g_vehicles},
+            "stations": {station.name: {"raining": station.raining} for station in g_stations}
+        }
+        key = json.dumps(state, sort_keys=True)
+
+        with self.lock:
+            spent = g_budgets.spent
+            if key == self.written and (spent == self.spent or (not final and time.monotonic() - self.written_at < 10)):
+                return
+
+            # Ages and delays change all the time so they don't count as a change, but they're saved with the rest
+            now = time.monotonic()
+            for vehicle in g_vehicles:
+                saved = state["vehicles"][vehicle.vin]
+                saved["next_poll"] = round(max(0.0, vehicle.next_poll - now))
+                if vehicle.snapshots.snapshot is not None:
+                    saved["snapshot_age"] = round(now - vehicle.snapshots.snapshot.time, 1)
+            state["budgets"] = g_budgets.to_dict()
+            state["saved_at"] = time.time()
+
+            try:
+                write_atomically(self.filename, json.dumps(state))
+                self.written = key
+                self.written_at = now
+                self.spent = spent
+            except Exception as error:
+                printWithTime("Tesla: Unable to save our state because of exception: " + type(error).__name__)
+
+# How likely it is to rain soon (0 to 1) from OWM's current weather. Thunderstorm, drizzle, rain and snow (2xx, 3xx, 5xx and 6xx)
+# mean it's already falling, otherwise we go with the cloud cover
+def rain_chance(data):
+    if data is None:
+        return 0.0
+    try:
+        if int(data['weather'][0]['id']) // 100 in (2, 3, 5, 6):
+            return 1.0
+        return float(data.get('clouds', {}).get('all', 0)) / 100.0
+    except (KeyError, IndexError, TypeError, ValueError):
+        return 0.0
+
+# When OWM's minutely forecast (One Call 'minutely', in mm/h) expects at least 'threshold' of precipitation within 'lead' seconds
+# of 'now' (epoch). Returns how many seconds until it starts and how much, or None if it doesn't expect any
+def nowcast_rain(data, now, lead, threshold):
+    if data is None:
+        return None
+    try:
+        for minute in data.get('minutely', []):
+            if minute['dt'] + 60 <= now:
+                continue # That minute is already over
+            if minute['dt'] > now + lead:
+                break
+            if float(minute.get('precipitation', 0.0)) >= threshold:
+                return max(0.0, minute['dt'] - now), float(minute['precipitation'])
+    except (KeyError, TypeError, ValueError):
+        pass
+    return None
+
+# Decides in how many seconds the timer should check that vehicle again, from what we read about it since 'checked' (monotonic)
+def next_poll_interval(vehicle, now, checked):
+    snapshot = vehicle.snapshots.snapshot
+    if snapshot is None or vehicle.snapshots.expires < checked or not snapshot.complete or vehicle.retry != 0:
+        return g_poll_min, "unknown state or retrying" # Couldn't read it, or we closed its windows and want to see the result
+
+    position = snapshot.position()
+    if position is None:
+        position = (station_latitude, station_longitude)
+
+    ceiling = g_poll_max
+    if vehicle.snapshots.pushed_at is not None:
+        ceiling = max(g_push_poll, g_poll_min)
+        interval = ceiling # We'll hear about it when it changes, only poll in case its pushes stopped
+        reason = "state is pushed"
+    elif not snapshot.parked():
+        return g_poll_min, "driving"
+    elif snapshot.windows_opened():
+        chance = 0.0
+        if owm_key is not None:
+            chance = rain_chance(g_weather.peek(position[0], position[1]))
+        if g_nowcast is not None and nowcast_rain(g_nowcast.peek(position[0], position[1]), time.time(), 3600, g_nowcast_threshold) is not None:
+            chance = 1.0 # Expected within the hour, watch it closely until the lead time brings it in range
+        interval = g_poll_min + (g_poll_parked - g_poll_min) * (1.0 - chance) # The more it looks like rain, the closer we watch
+        reason = "windows opened with {:.0%} chance of rain".format(chance)
+    elif snapshot.status == "asleep":
+        interval = g_poll_max # It can't open its windows without waking up first
+        reason = "asleep"
+    else:
+        interval = g_poll_parked
+        reason = "parked"
+
+    # Don't sleep through sunset, that's when we close the windows
+    now_tz = g_ephemeris.timezone.localize(now)
+    today_sr, today_ss, tomorrow_sr = g_ephemeris.get(now_tz, position[0], position[1])
+    if now_tz < today_ss:
+        until_sunset = (today_ss - now_tz).total_seconds() + 1
+        if until_sunset < interval:
+            interval = until_sunset
+            reason += " until sunset"
+
+    return min(max(interval, g_poll_min), ceiling), reason
+
+def schedule_vehicle(vehicle, now, checked):
+    interval, reason = next_poll_interval(vehicle, now, checked)
+    vehicle.next_poll = time.monotonic() + interval
+    if (g_debug & 3) > 1:
+        printWithTime("Tesla-Timer: Debug: Checking VIN " + vehicle.vin + " again in " + str(int(interval)) + " seconds (" + reason + ")")
+
+# Class used to drive paho from our event loop instead of its own network thread. paho tells us when its socket opens, closes
+# or has data to write and the event loop calls it back when that socket is readable or writable
+class MqttAsyncioHelper:
+    def __init__(self, loop, client):
+        self.loop = loop
+        self.client = client
+        client.on_socket_open = self.on_socket_open
+        client.on_socket_close = self.on_socket_close
+        client.on_socket_register_write = self.on_socket_register_write
+        client.on_socket_unregister_write = self.on_socket_unregister_write
+
+    # These can be called from the thread doing the blocking connect so hand them over to the event loop
+    def on_socket_open(self, client, userdata, sock):
+        self.loop.call_soon_threadsafe(self.loop.add_reader, sock.fileno(), self.on_readable)
+
+    def on_socket_close(self, client, userdata, sock):
+        self.loop.call_soon_threadsafe(self.loop.remove_reader, sock.fileno())
+
+    def on_socket_register_write(self, client, userdata, sock):
+        self.loop.call_soon_threadsafe(self.loop.add_writer, sock.fileno(), client.loop_write)
+
+    def on_socket_unregister_write(self, client, userdata, sock):
+        self.loop.call_soon_threadsafe(self.loop.remove_writer, sock.fileno())
+
+    def on_readable(self):
+        self.client.loop_read()
+        sock = self.client.socket()
+        while sock is not None and hasattr(sock, "pending") and sock.pending() > 0: # TLS can hold decrypted data the socket won't signal
+            self.client.loop_read()
+            sock = self.client.socket()
+
+    # Keeps the connection alive and reconnects with an increasing delay when it's lost. With 'reconnect', like when the
+    # supervisor restarts us because the station went quiet, the connection we have is dropped and a new one is made
+    async def run(self, reconnect=False):
+        if reconnect:
+            g_core.post("mqtt_reconnect")
+
+        delay = 1
+        while True:
+            if self.client.socket() is None or reconnect:
+                reconnect = False
                 try:
-                    sender = Emailer()
-                    sender.sendmail(sendTo, emailSubject, emailBody)
+                    await asyncio.wait_for(asyncio.to_thread(self.client.reconnect), 30)
+                    delay = 1
+                    g_core.post("recovered")
                 except Exception as error:
-                    if (g_debug & 3) > 0:
-                        printWithTime("Tesla-WD: Unable to send email because of exception: " + type(error).__name__)
+                    emailBody = "Unable to connect to MQTT. Error " + type(error).__name__
+                    if g_core.post("error"):
+                        send_email("Tesla: " + emailBody, emailBody)
+
+                    printWithTime("Tesla-MQTT: " + emailBody + ", retrying in " + str(delay) + " seconds")
+                    sd_notify("STATUS=" + emailBody + ", retrying")
+                    await asyncio.sleep(delay)
+                    delay = min(delay * 2, 60)
+                    continue
+
+            self.client.loop_misc() # Keepalive pings
+            await asyncio.sleep(1)
+
+# Runs on_timer every g_t_sec seconds. A run that takes too long is cancelled so the next one can start. Supervised as 'poller'
+async def timer_loop():
+    while True:
+        start = time.monotonic()
+        try:
+            with g_supervisor.busy("poller"):
+                await asyncio.wait_for(on_timer(), g_wd_timer - 5)
+        except asyncio.TimeoutError:
+            g_metrics.count("tesla_errors_total", stage="tick_timeout")
+            emailBody = "Timer took more than " + str(g_wd_timer - 5) + " seconds, cancelled it"
+            printWithTime("Tesla-Timer: " + emailBody)
+            if g_core.post("error"):
+                send_email("Tesla-Timer: " + emailBody, emailBody)
+        else:
+            g_core.post("recovered")
 
-                printWithTime(emailSubject)
+        # Sleep until our next tick, unless an MQTT rain transition asks us to look at a vehicle sooner
+        try:
+            await asyncio.wait_for(g_poll_now.wait(), max(0.0, g_t_sec - (time.monotonic() - start)))
+        except asyncio.TimeoutError:
+            pass
+        g_poll_now.clear()
+
+# One of the parts of our work the supervisor watches: MQTT connection, MQTT ingestion, rain checks, polling and emails
+class Component:
+    def __init__(self, name, start, deadline, stop=None, healthy=None):
+        self.name = name
+        self.start = start          # Called to (re)start it, returns its asyncio task or its thread
+        self.deadline = deadline    # Seconds it can stay busy on one piece of work before we call it stuck, None if it can't get stuck
+        self.stop = stop            # Called to get rid of it when it's stuck. Tasks are cancelled, threads need this
+        self.healthy = healthy      # Optional check returning False when it's running but not doing its job
+        self.handle = None
+        self.busy_since = None      # time.monotonic() since it's been working on something, None while it's waiting for work
+        self.restarts = []          # time.monotonic() of its recent restarts
+        self.restart_at = None      # When it's due to be started again after a failure
+        self.backoff = 0
+
+    def alive(self):
+        if isinstance(self.handle, Thread):
+            return self.handle.is_alive()
+        return self.handle is not None and not self.handle.done()
+
+# Class used to keep our components running. A component that stops, stays busy past its deadline or reports it isn't healthy
+# is stopped and started again, right away the first time and then with a delay doubling up to a minute. Quitting so systemd
+# respawns us is only done when a component had to be restarted more than 'max_restarts' times within 'window' seconds
+class Supervisor:
+    def __init__(self, max_restarts, window, report):
+        self.max_restarts = max_restarts
+        self.window = window
+        self.report = report        # Seconds between our debug reports
+        self.components = {}
+        self.wake = None
+
+    def add(self, component, handle=None):
+        self.components[component.name] = component
+        component.handle = handle if handle is not None else component.start()
+        self.watch(component)
+
+    def watch(self, component):
+        if isinstance(component.handle, asyncio.Task) and self.wake is not None:
+            component.handle.add_done_callback(lambda task: self.wake.set()) # Don't wait for our next check to restart it
+
+    # Marks a component as working on something for the time of a 'with' block. Can be used from any thread
+    def busy(self, name):
+        return SupervisorBusy(self.components.get(name))
+
+    async def run(self):
+        self.wake = asyncio.Event()
+        for component in list(self.components.values()):
+            self.watch(component)
+
+        next_report = time.monotonic() + self.report
+        while True:
+            try:
+                await asyncio.wait_for(self.wake.wait(), 1)
+            except asyncio.TimeoutError:
+                pass
+            self.wake.clear()
+
+            now = time.monotonic()
+            for component in list(self.components.values()): # Components can be added while we're restarting one
+                if component.restart_at is not None:
+                    if now >= component.restart_at:
+                        self.start_again(component)
+                    continue
+
+                if not component.alive():
+                    reason = "it stopped"
+                    if isinstance(component.handle, asyncio.Task) and not component.handle.cancelled() and component.handle.exception() is not None:
+                        reason = "it failed with exception " + type(component.handle.exception()).__name__ + " " + str(component.handle.exception())
+                    await self.restart(component, reason)
+                elif component.deadline is not None and component.busy_since is not None and now - component.busy_since > component.deadline:
+                    await self.restart(component, "it has been busy for more than " + str(component.deadline) + " seconds")
+                elif component.healthy is not None and not component.healthy():
+                    await self.restart(component, "it isn't doing its job")
+                elif component.backoff > 0 and (len(component.restarts) == 0 or now - component.restarts[-1] > self.window):
+                    component.backoff = 0 # It's been fine for a while
+
+            if now >= next_report:
+                next_report = now + self.report
+                self.debug_report()
+
+    async def restart(self, component, reason):
+        now = time.monotonic()
+        component.restarts = [restart for restart in component.restarts if now - restart < self.window] + [now]
+        g_metrics.count("tesla_restarts_total", component=component.name)
+
+        if isinstance(component.handle, asyncio.Task):
+            component.handle.cancel()
+        elif component.stop is not None:
+            component.stop()
+
+        if len(component.restarts) > self.max_restarts:
+            emailSubject = "Tesla-WD: '" + component.name + "' had to be restarted " + str(len(component.restarts)) + " times in " + str(self.window) + " seconds, quitting program"
+            emailBody = "Last time because " + reason
+            send_email(emailSubject, emailBody)
+            printWithTime(emailSubject)
+            printWithTime("Tesla-WD: " + emailBody)
+            await asyncio.to_thread(g_outbox.flush, 30) # Give our email a chance to go out
+            quit(1) # Quit so systemctl respawn the process, restarting that part of it wasn't enough
+
+        emailSubject = "Tesla-WD: Restarting '" + component.name + "'" + ("" if component.backoff == 0 else " in " + str(component.backoff) + " seconds")
+        emailBody = "Because " + reason
+        printWithTime(emailSubject + " because " + reason)
+        send_email(emailSubject, emailBody)
+
+        component.restart_at = now + component.backoff
+        if component.backoff == 0:
+            self.start_again(component)
+        component.backoff = min(max(1, component.backoff * 2), 60)
+
+    def start_again(self, component):
+        component.restart_at = None
+        component.busy_since = None
+        printWithTime("Tesla-WD: Starting '" + component.name + "' again")
+        component.handle = component.start()
+        self.watch(component)
+
+    def debug_report(self):
+        view = g_core.view
+        if (g_debug & 3) > 1:
+            printWithTime("Tesla-WD: Debug: HTTP connections: " + g_http.stats_text())
+            if owm_key is not None:
+                printWithTime("Tesla-WD: Debug: OWM " + g_weather.stats_text())
+            if g_nowcast is not None:
+                printWithTime("Tesla-WD: Debug: OWM forecast " + g_nowcast.stats_text())
+            if not g_skip_mqtt:
+                printWithTime("Tesla-WD: Debug: MQTT queue " + str(g_mqtt_queue.qsize()) + "/" + str(g_mqtt_queue.maxsize) + ", " + str(view.mqtt_dropped) + " packets dropped")
 
-                g_kill_prog = True
+        if (g_debug & 3) > 0:
+            if g_skip_mqtt:
+                printWithTime("Tesla-WD: last timer thread ran at " + view.timer_last_run.strftime("%H:%M:%S"))
+            else:
+                printWithTime("Tesla-WD: Last mqtt thread ran at " + view.mqtt_last_run.strftime("%H:%M:%S") + " last timer thread ran at " + view.timer_last_run.strftime("%H:%M:%S"))
 
-                quit(1) # Quit so systemctl respawn the process because 60 seconds without data from the station isn't normal. Not elegant but does the work
+class SupervisorBusy:
+    def __init__(self, component):
+        self.component = component
 
-    # If our last timer run plus in the time it takes to run the wd timer is less than now, the timer hasn't ran for too long
-    if g_timer_lastRun + timedelta(seconds = g_wd_timer) < now:
-        if g_timer_ran == True:
-            g_timer_ran = False
+    def __enter__(self):
+        if self.component is not None:
+            self.component.busy_since = time.monotonic()
+        return self
 
-            emailBody = "Last ran at " + g_timer_lastRun.strftime("%H:%M:%S")
-            emailSubject = "Tesla-WD: Timer thread hasn't ran in over " + str(g_wd_timer) + " secondes, quitting program"
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.component is not None:
+            self.component.busy_since = None
+        return False
 
-            try:
-                sender = Emailer()
-                sender.sendmail(sendTo, emailSubject, emailBody)
-            except Exception as error:
-                if (g_debug & 3) > 0:
-                    printWithTime("Tesla-WD: Unable to send email because of exception: " + type(error).__name__)
+# The station is talking to us if we got one of its packets in the last g_wd_mqtt_max seconds
+def mqtt_healthy():
+    return g_core.view.mqtt_last_run + timedelta(seconds = g_wd_mqtt_max) >= datetime.now()
 
-            printWithTime(emailSubject)
-            printWithTime("Tesla-WD: " + emailBody)
+# The timer ran in the last g_wd_timer seconds
+def timer_healthy():
+    return g_core.view.timer_last_run + timedelta(seconds = g_wd_timer) >= datetime.now()
 
-            g_kill_prog = True
-            
-            quit(1) # Quit so systemctl respawn the process because 90 seconds without running the timer isn't normal. Not elegant but does the work
-
-def on_timer():
-    global g_night
-    global g_timer_lastRun
-    global g_timer_ran
-    global g_out_temp
-    global g_windows
-    global g_moving
-    global g_longitude
-    global g_latitude
-    global g_owm_raining
-    global g_mqtt_raining
-    global g_already_sent_email_after_error
-    global g_kill_prog
-    global g_retry
-    global g_debug
-    global g_in_timer
-    global g_wd_timer
-    
-    printWithTime("Tesla-Timer: ****************************************************")
-    
+async def on_timer():
     now = datetime.now()
-    g_timer_lastRun = now
-    g_timer_ran = True
+    g_core.post("tick", now=now)
     
     if (g_debug & 3) > 1:
-        printWithTime("Tesla-Timer: Debug: Setting g_timer_lastRun to " + g_timer_lastRun.strftime("%H:%M:%S"))
+        printWithTime("Tesla-Timer: Debug: Setting the timer's last run to " + now.strftime("%H:%M:%S"))
 
-    g_in_timer += 1
-    if g_in_timer == 2:
-        printWithTime("Tesla-Timer: Timer thread already running, skipping this iteration")
-        return
-    
-    if g_in_timer == 3:
-        g_kill_prog = True;
-
-        if g_already_sent_email_after_error == False:
-            g_already_sent_email_after_error = True
-
-            emailBody = "Timer thread already running FOR TWO ITERARIONS! We must be hung, quiting"
-            emailSubject = "Tesla-Timer: " + emailBody
+    if g_skip_mqtt: # Even if no vehicle is due yet, like when our state file says we just checked them
+        report_ready("OWM")
 
-            try:
-                sender = Emailer()
-                sender.sendmail(sendTo, emailSubject, emailBody)
-            except Exception as error:
-                printWithTime("Tesla-Timer: Unable to send email because of exception: " + type(error).__name__)
-
-            printWithTime("Tesla-Timer: " + emailBody)
+    # Only the vehicles that are due, the others are asleep, in the garage or it's a clear sky
+    due = [vehicle for vehicle in g_vehicles if vehicle.next_poll <= time.monotonic()]
+    if len(due) == 0:
+        return
 
-            quit(1) # Quit so systemctl respawn the process because we were asked to quit. Not elegant but does the work
+    printWithTime("Tesla-Timer: ****************************************************")
 
-        return
-    
-    if g_kill_prog == True:
-        printWithTime("Tesla-Timer: Asked to quit")
-        quit(1) # Quit so systemctl respawn the process because we were asked to quit. Not elegant but does the work
-    
-    # Get the state of the vehicle first
-    printWithTime("Tesla-Timer: Timer Hang Debug: Querying Tessie Status")
-    vehicle_status = get_vehicle_status()
+    # Check our vehicles, a few at a time
+    checked = time.monotonic()
+    with g_metrics.span("tick"):
+        results = await asyncio.gather(*(in_fleet_slot(check_vehicle(vehicle, now)) for vehicle in due), return_exceptions=True)
+    for vehicle, result in zip(due, results):
+        if isinstance(result, Exception):
+            g_metrics.count("tesla_errors_total", stage="check_vehicle")
+            printWithTime("Tesla-Timer: Checking VIN " + vehicle.vin + " failed with exception: " + type(result).__name__ + " " + str(result))
+        schedule_vehicle(vehicle, now, checked)
+
+    if g_state is not None:
+        g_state.checkpoint()
+
+async def check_vehicle(vehicle, now):
+    # Get the weather where the vehicle was last time (usually where it still is) while we read the vehicle
+    weather = None
+    if owm_key is not None:
+        weather_position = vehicle.snapshots.last_position()
+        if weather_position is None:
+            weather_position = (station_latitude, station_longitude)
+        weather = asyncio.ensure_future(asyncio.to_thread(g_weather.get, weather_position[0], weather_position[1]))
 
-    printWithTime("Tesla-Timer: Timer Hang Debug: Querying Tessie State")
-    
-    # Read data that I need from the vehicle
-    response = tessie("state", "?use_cache=true", g_t_sec)
-    if response.status_code != 200:
-        if response.status_code != -300:
-            if g_already_sent_email_after_error == False:
-                g_already_sent_email_after_error = True
+    # Get the state of the vehicle first and read data that I need from the vehicle
+    printWithTime("Tesla-Timer: Timer Hang Debug: Querying Tessie Status and State")
+    try:
+        snapshot = await vehicle.snapshots.get()
+    except asyncio.CancelledError:
+        if weather is not None:
+            weather.cancel()
+        raise
+    vehicle_status = snapshot.status
+
+    if snapshot.status_code != 200:
+        if snapshot.status_code == -429: # Out of budget, that's by design and not worth an email
+            g_metrics.count("tesla_checks_skipped_total", check="timer", reason="budget")
+            if (g_debug & 3) > 0:
+                printWithTime("Tesla-Timer: Not checking VIN " + vehicle.vin + vehicle.suffix + ", our Tessie budget is spent")
+        elif snapshot.status_code != -300:
+            if vehicle.already_sent_email_after_error == False:
+                vehicle.already_sent_email_after_error = True
 
-                emailBody = "Error #" + str(response.status_code) + " getting vehicle data for VIN " + vin
-                emailSubject = "Tesla-Timer: " + emailBody
+                emailBody = "Error #" + str(snapshot.status_code) + " getting vehicle data for VIN " + vehicle.vin
+                emailSubject = "Tesla-Timer: " + emailBody + vehicle.suffix
 
-                try:
-                    sender = Emailer()
-                    sender.sendmail(sendTo, emailSubject, emailBody)
-                except Exception as error:
-                    printWithTime("Tesla-Timer: Unable to send email because of exception: " + type(error).__name__)
+                send_email(emailSubject, emailBody)
 
                 if (g_debug & 3) > 0:
                     printWithTime(emailSubject)
                     printWithTime("Tesla-Timer: " + emailBody)
 
-        g_in_timer = 0
         return;
     
     printWithTime("Tesla-Timer: Timer Hang Debug: Tessie queried, getting vehicle parameters")
 
-    vehicle_state = response.json().get("vehicle_state")
-    climate_state = response.json().get("climate_state")
-    charge_state  = response.json().get("charge_state")
-    drive_state   = response.json().get("drive_state")
-    
-    if vehicle_state == None or drive_state == None or climate_state == None or charge_state == None:
-        if g_already_sent_email_after_error == False:
-            g_already_sent_email_after_error = True
+    if not snapshot.complete:
+        if vehicle.already_sent_email_after_error == False:
+            vehicle.already_sent_email_after_error = True
 
-            emailBody = "Missing data reading vehicle state for VIN " + vin
-            emailSubject = "Tesla-Timer: " + emailBody
+            emailBody = "Missing data reading vehicle state for VIN " + vehicle.vin
+            emailSubject = "Tesla-Timer: " + emailBody + vehicle.suffix
 
-            try:
-                sender = Emailer()
-                sender.sendmail(sendTo, emailSubject, emailBody)
-            except Exception as error:
-                printWithTime("Tesla-Timer: Unable to send email because of exception: " + type(error).__name__)
+            send_email(emailSubject, emailBody)
 
             printWithTime("Tesla-Timer: " + emailBody)
 
-        g_in_timer = 0
         return;
 
-    g_already_sent_email_after_error = False; 
+    vehicle.already_sent_email_after_error = False; 
 
-    g_moving = drive_state['shift_state']
-    if g_moving is not None and g_moving != "P":
+    if not snapshot.parked():
         if (g_debug & 3) > 0:
             printWithTime("Tesla-Timer: Vehicle in motion, skipping checking inside temperature and windows")
-            g_in_timer = 0
             return
 
-    fd_window = int(vehicle_state['fd_window'])
-    fp_window = int(vehicle_state['fp_window'])
-    rd_window = int(vehicle_state['rd_window'])
-    rp_window = int(vehicle_state['rp_window'])
-    g_windows = fd_window + fp_window + rd_window + rp_window # 0 means close so when we add them up, anything but 0 means at least a window is opened
-
-    g_latitude  = drive_state['latitude']
-    g_longitude = drive_state['longitude']
-    
-    if g_latitude == None or g_longitude == None:
+    position = snapshot.position()
+    if position is None:
         if (g_debug & 3) > 1:
             printWithTime("Tesla-Timer: Debug: Missing Latitude or Longitude, assuming we're at our station")
         latitude = station_latitude
         longitude = station_longitude
     else:
-        latitude = g_latitude
-        longitude = g_longitude
+        latitude, longitude = position
+        if (g_debug & 3) > 1:
+            fence = find_geofence(latitude, longitude)
+            if fence is not None:
+                printWithTime("Tesla-Timer: Debug: Vehicle is parked at '" + fence.name + "'")
     
     printWithTime("Tesla-Timer: Timer Hang Debug: Finish building vehicle parameters, querying sun")
 
     # Check if the sun has set and if our windows are still opened
-    sun = Sun(latitude, longitude)
-    today_sr = sun.get_sunrise_time()
-    today_ss = sun.get_sunset_time()
-    tz_toronto = pytz.timezone('America/Toronto')
-    now_tz = tz_toronto.localize(now)
-    if today_sr > today_ss:
-        today_ss = today_ss + timedelta(days=1) # Bug in the routine, day isn't update when crossing over midnight in UTC timezone
-    
+    now_tz = g_ephemeris.timezone.localize(now)
+    with g_metrics.span("ephemeris"):
+        today_sr, today_ss, tomorrow_sr = g_ephemeris.get(now_tz, latitude, longitude)
+
     if g_debug & 0x4000:
         printWithTime("Tesla-Timer: Debug: today_sr: " + str(today_sr))
         printWithTime("Tesla-Timer: Debug: today_ss: " + str(today_ss))
         printWithTime("Tesla-Timer: Debug: now_tz: " + str(now_tz))
 
-    g_owm_raining = False # We assume it's not raining
+    vehicle.owm_raining = False # We assume it's not raining
 
     printWithTime("Tesla-Timer: Timer Hang Debug: Sun queried, analysing results")
 
     if today_sr > now_tz or now_tz > today_ss:
         printWithTime("Tesla-Timer: Timer Hang Debug: Doing night stuff")
-        if now_tz > today_sr:
-            tomorrow_sr = sun.get_sunrise_time() + timedelta(days=1)
-        else:
-            tomorrow_sr = sun.get_sunrise_time()
-        
+        if now_tz < today_sr: # Still before today's sunrise
+            tomorrow_sr = today_sr
+
         if (g_debug & 3) > 1:
             printWithTime("Tesla-Timer: Debug: It's night with " + str(tomorrow_sr - now_tz) + " until sunrise")
-        if g_night == False or g_retry == 10:  # First time going in since the sun has set, check if we're parked with the windows down and if so, close them
+        if vehicle.night == False or vehicle.retry == 10:  # First time going in since the sun has set, check if we're parked with the windows down and if so, close them
             sendEmail = True
-            if g_retry == 10: # If we got here because we timed out, reset it back to 0
-                g_retry = 0
-            g_night = True
+            if vehicle.retry == 10: # If we got here because we timed out, reset it back to 0
+                vehicle.retry = 0
+            vehicle.night = True
             if (g_debug & 3) > 0:
                 printWithTime("Tesla-Timer: It's night, check if our windows are closed")
-            if g_windows is not None and g_windows > 0:
-                waitTime = g_wd_timer - 5
-                if waitTime > 90:
-                    waitTime = 90
-                response = tessie("command/close_windows", "?retry_duration=" + str(waitTime), waitTime)
+            if snapshot.windows_opened():
+                response, shared = await vehicle.closer.close(snapshot) # Shares the answer if the rain already got them closing
                 status_code = response.status_code
-                if status_code == 200:
+                if shared: # We didn't send that command, whoever did reports it
+                    sendEmail = False
+                    emailSubject = "Tesla-Timer: Windows of VIN " + vehicle.vin + " are already being closed or just were, status code was " + str(status_code)
+                elif status_code == 200:
                     
                     result = response.json().get("result")
-                    woke = response.json().get("woke")
                     if result == True:
-                        g_retry = 0
+                        vehicle.retry = 0
                         emailBody = "Closing windows because it's night time."
 
                         now = datetime.now()
                         current_time = now.strftime("%H:%M:%S")
-                        emailSubject = "Tesla-Timer: Windows were opened at sunset (" + current_time + ")"
+                        emailSubject = "Tesla-Timer: Windows were opened at sunset (" + current_time + ")" + vehicle.suffix
                     else:
-                        g_retry = g_retry + 1
+                        vehicle.retry = vehicle.retry + 1
                         emailBody = "Unable to close windows at sunset. Check vehicle!"
 
-                        emailSubject = "Tesla-Timer: " + emailBody
+                        emailSubject = "Tesla-Timer: " + emailBody + vehicle.suffix
                 else:
-                    g_retry = g_retry + 1
+                    vehicle.retry = vehicle.retry + 1
                     emailBody = "Unable to close windows at sunset. Status code was " + str(status_code) + " Check vehicle!"
 
-                    emailSubject = "Tesla-Timer: " + emailBody
+                    emailSubject = "Tesla-Timer: " + emailBody + vehicle.suffix
             else:
-                g_retry = 0
+                vehicle.retry = 0
                 now = datetime.now()
                 current_time = now.strftime("%H:%M:%S")
                 emailBody = "Windows were closed at sunset (" + current_time + ")"
-                emailSubject = "Tesla-Timer: " + emailBody
+                emailSubject = "Tesla-Timer: " + emailBody + vehicle.suffix
 
                 if sendDailyEmail == False:
                     sendEmail = False
 
             if sendEmail:
-                try:
-                    sender = Emailer()
-                    sender.sendmail(sendTo, emailSubject, emailBody)
-                except Exception as error:
-                    printWithTime("Tesla-Timer: Unable to send email because of exception: " + type(error).__name__)
+                send_email(emailSubject, emailBody)
 
             printWithTime(emailSubject)
 
-        elif g_retry != 0: # If we got an error when trying to close the windows, wait 10 iteration cycles and try again
-            g_retry = g_retry + 1
+        elif vehicle.retry != 0: # If we got an error when trying to close the windows, wait 10 iteration cycles and try again
+            vehicle.retry = vehicle.retry + 1
     else:
         printWithTime("Tesla-Timer: Timer Hang Debug: Doing day stuff")
-        g_night = False
+        vehicle.night = False
         if (g_debug & 3) > 1:
             printWithTime("Tesla-Timer: Debug: It's daytime with " + str(today_ss - now_tz) + " until sunset")
 
@@ -628,63 +2250,62 @@ def on_timer():
     printWithTime("Tesla-Timer: Timer Hang Debug: Doing OWM stuff")
 
     if owm_key is not None:
-        URL = "https://api.openweathermap.org/data/2.5/weather?lat=" + str(latitude) + "&lon=" + str(longitude) + "&appid=" + str(owm_key)
-        if g_debug & 0x100:
-            printWithTime("OWM URL = " + URL)
-
-        response = requests.get(URL)
+        status_code, data = await weather
+        if g_weather.key(weather_position[0], weather_position[1]) != g_weather.key(latitude, longitude): # The vehicle moved since
+            status_code, data = await asyncio.to_thread(g_weather.get, latitude, longitude)
         printWithTime("Tesla-Timer: Timer Hang Debug: OWM queried, analysing results")
-        if response.status_code == 200:
-            if g_debug & 0x200:
-                printWithTime(json.dumps(response.json(), indent = 4))
-            data = response.json()
+        if status_code == 200:
 
-            # Favor the car temperature
-            g_out_temp = None
+            # Favor the car temperature, then our station's, then OWM's
+            out_temp = None
             if vehicle_status == "awake":
-                g_out_temp = climate_state['outside_temp']
+                out_temp = snapshot.outside_temp
                 if (g_debug & 3) > 1:
-                    if g_out_temp is None:
+                    if out_temp is None:
                         printWithTime("Tesla-Timer: Debug: Can't read the car's outside temperature")
                     else:
-                        printWithTime("Tesla-Timer: Debug: Outside temperature according to the car is " + "{:.1f}".format(g_out_temp) + "C")
-            if g_out_temp is None and "temp" in data['main']:
-                g_out_temp = float(data['main']['temp']) - 273.15
+                        printWithTime("Tesla-Timer: Debug: Outside temperature according to the car is " + "{:.1f}".format(out_temp) + "C")
+            if out_temp is None:
+                station, out_temp = station_temperature(latitude, longitude)
+                if out_temp is not None and (g_debug & 3) > 1:
+                    printWithTime("Tesla-Timer: Debug: Outside temperature according to station '" + station.name + "' is " + "{:.1f}".format(out_temp) + "C")
+            if out_temp is None and "temp" in data['main']:
+                out_temp = float(data['main']['temp']) - 273.15
                 if (g_debug & 3) > 1:
-                    printWithTime("Tesla-Timer: Debug: Outside temperature according to OWM station '" + data['name'] + "' is " + "{:.1f}".format(g_out_temp) + "C")
+                    printWithTime("Tesla-Timer: Debug: Outside temperature according to OWM station '" + data['name'] + "' is " + "{:.1f}".format(out_temp) + "C")
 
-            if g_windows is not None and g_windows > 0:
+            if snapshot.windows_opened():
                 if (g_debug & 3) > 0:
                     printWithTime("Tesla-Timer: Windows are opened")
             
             if vehicle_status == "awake":
                 if g_debug & 0x800:
-                    printWithTime("Tesla-Timer: Debug: Climate is " + json.dumps(climate_data, indent = 4))
-                inside_temp = climate_state['inside_temp']
-                active_cooling =  climate_state['cabin_overheat_protection_actively_cooling']
+                    printWithTime("Tesla-Timer: Debug: Vehicle is " + repr(snapshot))
+                inside_temp = snapshot.inside_temp
+                active_cooling = snapshot.active_cooling
 
             icon = data['weather'][0]['icon']
-            if int(icon[0:2]) < 4 and str(icon[2:3]) == "d": # Icon with a number lower than 4 means there is some sun showing and 'd' means it's daytime
-                if today_sr + timedelta(hours=3) < now_tz < today_ss - timedelta(hours=3): # Sun is up high enough in the sky
-                    if g_out_temp is not None and g_out_temp > 10.0: # Below 10C means it's not hot enough to overheat the cabin
-                        # Before we go any further, we must make sure the battery level is at least 20% to prevent running down the battery too much
-                        soc = charge_state['battery_level']
-                        if soc is not None and soc >= 20:
+            if int(icon[0:2]) <= g_sunny_icon_max and str(icon[2:3]) == "d": # Icon with a low number means there is some sun showing and 'd' means it's daytime
+                if today_sr + timedelta(hours=g_sun_margin) < now_tz < today_ss - timedelta(hours=g_sun_margin): # Sun is up high enough in the sky
+                    if out_temp is not None and out_temp > g_warm_temp: # Below that it's not hot enough to overheat the cabin
+                        # Before we go any further, we must make sure the battery level is high enough to prevent running down the battery too much
+                        soc = snapshot.battery_level
+                        if soc is not None and soc >= g_min_soc:
                             if vehicle_status == "awake":
                                 #vehicles[vehicle].sync_wake_up()  # Keep the vehicle awake so cabin overheat protection can do its stuff if needed <- Only works for 12 hours after a drive, not when awaken :-(
                                 if (g_debug & 3) > 1:
                                     printWithTime("Tesla-Timer: Debug: Fan is running: " + str(active_cooling))
-                                    printWithTime("Tesla-Timer: Debug: Some sun at least with " + data['weather'][0]['description'] + " (" + str(icon) + ") according to OWM station '" + data['name'] + "' during mid-day and outside is warm at " + "{:.1f}".format(g_out_temp) + "C with inside at " + "{:.1f}".format(inside_temp) + "C - The vehicle is awake!")
+                                    printWithTime("Tesla-Timer: Debug: Some sun at least with " + data['weather'][0]['description'] + " (" + str(icon) + ") according to OWM station '" + data['name'] + "' during mid-day and outside is warm at " + "{:.1f}".format(out_temp) + "C with inside at " + "{:.1f}".format(inside_temp) + "C - The vehicle is awake!")
                             else:
                                 if (g_debug & 3) > 1:
-                                    printWithTime("Tesla-Timer: Debug: Some sun at least with " + data['weather'][0]['description'] + " (" + str(icon) + ") according to OWM station '" + data['name'] + "' during mid-day and outside is warm at " + "{:.1f}".format(g_out_temp) + "C - Vehicle is asleep so can't get its inside temperature")
+                                    printWithTime("Tesla-Timer: Debug: Some sun at least with " + data['weather'][0]['description'] + " (" + str(icon) + ") according to OWM station '" + data['name'] + "' during mid-day and outside is warm at " + "{:.1f}".format(out_temp) + "C - Vehicle is asleep so can't get its inside temperature")
                         else:
                             if (g_debug & 3) > 1:
-                                printWithTime("Tesla-Timer: Debug: Some sun at least with " + data['weather'][0]['description'] + " (" + str(icon) + ") according to OWM station '" + data['name'] + "' during mid-day and outside is warm at " + "{:.1f}".format(g_out_temp) + "C but not waking the vehicle because SoC at " + str(soc) + "%")
+                                printWithTime("Tesla-Timer: Debug: Some sun at least with " + data['weather'][0]['description'] + " (" + str(icon) + ") according to OWM station '" + data['name'] + "' during mid-day and outside is warm at " + "{:.1f}".format(out_temp) + "C but not waking the vehicle because SoC at " + str(soc) + "%")
                     else:
                         if (g_debug & 3) > 1:
-                            if g_out_temp is not None:
-                                printWithTime("Tesla-Timer: Debug: Some sun at least with " + data['weather'][0]['description'] + " (" + str(icon) + ") according to OWM station '" + data['name'] + "' during mid-day and outside is cold at " + "{:.1f}".format(g_out_temp) + "C")
+                            if out_temp is not None:
+                                printWithTime("Tesla-Timer: Debug: Some sun at least with " + data['weather'][0]['description'] + " (" + str(icon) + ") according to OWM station '" + data['name'] + "' during mid-day and outside is cold at " + "{:.1f}".format(out_temp) + "C")
                             else:
                                 printWithTime("Tesla-Timer: Debug: Some sun at least with " + data['weather'][0]['description'] + " (" + str(icon) + ") according to OWM station '" + data['name'] + "' during mid-day and can't read the outside temperature")
                 else:
@@ -697,12 +2318,12 @@ def on_timer():
                         else:
                             printWithTime("Tesla-Timer: Debug: Some sun at least with " + data['weather'][0]['description'] + " (" + str(icon) + ") according to OWM station '" + data['name'] + "' but too early or late to be warm enough in the car - The vehicle is sleeping")
             else: # It's not a clear sky or it's night
-                if int(icon[0:2]) >= 9 and int(icon[0:2]) <= 11: # But is it raining? 9: Shower rain, 10: Rain, 11: Thunderstorm
-                    if g_mqtt_raining == False and g_owm_raining == False: # We'll reset to False once the rain has stopped, so we don't keep pounding the vehicle for the same rain shower
-                        g_owm_raining = True # It's raining according to OWM, let's check our windows (and MQTT hasn't seen rain yet)
+                if int(icon[0:2]) >= g_rain_icon_min and int(icon[0:2]) <= g_rain_icon_max: # But is it raining?
+                    if station_raining_near(latitude, longitude) == False and vehicle.owm_raining == False: # We'll reset to False once the rain has stopped, so we don't keep pounding the vehicle for the same rain shower
+                        vehicle.owm_raining = True # It's raining according to OWM, let's check our windows (and MQTT hasn't seen rain yet)
                         if (g_debug & 3) > 1:
                             printWithTime("Tesla-Timer: Debug: Calling raining_check_windows")
-                        raining_check_windows(-1.0, data['name'])
+                        await raining_check_windows(vehicle, -1.0, data['name'])
                         if (g_debug & 3) > 1:
                             printWithTime("Tesla-Timer: Debug: Returning from raining_check_windows")
                     else:
@@ -713,19 +2334,165 @@ def on_timer():
                     if vehicle_status == "awake":
                         if (g_debug & 3) > 2:
                             if inside_temp is not None:
-                                printWithTime("Tesla-Timer: Debug: Sun shouldn't be visible with " + data['weather'][0]['description'] + " (" + str(icon) + ") according to OWM station '" + data['name'] + "' during mid-day and outside is warm at " + "{:.1f}".format(g_out_temp) + "C with inside at " + "{:.1f}".format(inside_temp) + "C - The vehicle is awake!")
+                                printWithTime("Tesla-Timer: Debug: Sun shouldn't be visible with " + data['weather'][0]['description'] + " (" + str(icon) + ") according to OWM station '" + data['name'] + "' during mid-day and outside is warm at " + "{:.1f}".format(out_temp) + "C with inside at " + "{:.1f}".format(inside_temp) + "C - The vehicle is awake!")
                             else:
-                                printWithTime("Tesla-Timer: Debug: Sun shouldn't be visible with " + data['weather'][0]['description'] + " (" + str(icon) + ") according to OWM station '" + data['name'] + "' during mid-day and outside is warm at " + "{:.1f}".format(g_out_temp) + "C and unable to read the inside temperature - The vehicle is awake!")
+                                printWithTime("Tesla-Timer: Debug: Sun shouldn't be visible with " + data['weather'][0]['description'] + " (" + str(icon) + ") according to OWM station '" + data['name'] + "' during mid-day and outside is warm at " + "{:.1f}".format(out_temp) + "C and unable to read the inside temperature - The vehicle is awake!")
                     else:
                         printWithTime("Tesla-Timer: Debug: Sun shouldn't be visible with " + data['weather'][0]['description'] + " (" + str(icon) + ") according to OWM station '" + data['name'] + "' - The vehicle is sleeping")
         else:
             if (g_debug & 3) > 1:
-                printWithTime("Tesla-Timer: Debug: OWN returned " + str(response.status_code))
+                printWithTime("Tesla-Timer: Debug: OWN returned " + str(status_code))
     elif (g_debug & 3) > 1:
         printWithTime("Tesla-Timer: Debug: No OWM token")
+
+    # Close the windows before the rain gets here when OWM's minutely forecast expects some. Only asked while our windows are
+    # opened and nobody has seen rain yet, so it doesn't cost a call the rest of the time
+    if g_nowcast is not None:
+        if snapshot.windows_opened() and snapshot.parked() and vehicle.owm_raining == False and station_raining_near(latitude, longitude) == False:
+            status_code, forecast = await asyncio.to_thread(g_nowcast.get, latitude, longitude)
+            if status_code == 200:
+                expected = nowcast_rain(forecast, time.time(), g_nowcast_lead, g_nowcast_threshold)
+                if expected is None:
+                    vehicle.nowcast_raining = False
+                    if (g_debug & 3) > 1:
+                        printWithTime("Tesla-Timer: Debug: OWM doesn't expect rain in the next " + str(int(g_nowcast_lead / 60)) + " minutes")
+                elif vehicle.nowcast_raining == False: # Only once per expected shower
+                    vehicle.nowcast_raining = True
+                    g_metrics.count("tesla_nowcast_closes_total")
+                    printWithTime("Tesla-Timer: OWM expects " + "{:.1f}".format(expected[1]) + " mm/h of rain in " + str(int(expected[0])) + " seconds, closing our windows")
+                    await raining_check_windows(vehicle, -1.0, "forecast", nowcast=expected)
+                elif (g_debug & 3) > 0:
+                    printWithTime("Tesla-Timer: Skipping, already acted on the rain OWM expects")
+            elif (g_debug & 3) > 1:
+                printWithTime("Tesla-Timer: Debug: OWM's forecast returned " + str(status_code))
+        elif not snapshot.windows_opened():
+            vehicle.nowcast_raining = False
     printWithTime("Tesla-Timer: Timer Hang Debug: Finished OWM stuff")
 
-    g_in_timer = 0
+
+async def check_vehicle_status(vehicle):
+    if vehicle.snapshots.snapshot is not None: # Restored from our state file, no need to ask again
+        print("Vehicle " + vehicle.vin + " was " + str(vehicle.snapshots.snapshot.status) + " before we restarted")
+        return
+
+    snapshot = await vehicle.snapshots.get() # Status and state together, the timer's first run will reuse them
+    vehicle_status = snapshot.status
+    if (vehicle_status == "asleep" or vehicle_status == "waiting_for_sleep"):
+        if wake_at_start == 1:
+            print("Waking up vehicle " + vehicle.vin)
+            await asyncio.to_thread(tessie, vehicle, "wake", "", g_wd_timer)
+            vehicle.snapshots.invalidate() # What we read was from before it woke up
+        else:
+            print("Vehicle " + vehicle.vin + " is asleep and we're not requesting it to be waken up")
+    elif vehicle_status == "awake":
+        print("Vehicle " + vehicle.vin + " is already awake")
+    else:
+        print("Vehicle " + vehicle.vin + " returned a status of " + vehicle_status)
+
+# The slow part of our start up, done while MQTT connects: the status of each vehicle (and its wake up) and the weather at our
+# station, all at the same time. The timer is started once they're done so its first run finds their answers in our caches
+async def startup():
+    print("Tesla: Checking vehicle's status")
+    probes = [in_fleet_slot(check_vehicle_status(vehicle)) for vehicle in g_vehicles]
+    if owm_key is not None:
+        probes.append(asyncio.to_thread(g_weather.get, station_latitude, station_longitude))
+    results = await asyncio.gather(*probes, return_exceptions=True)
+    for result in results:
+        if isinstance(result, Exception):
+            printWithTime("Tesla: Start up check failed with exception: " + type(result).__name__ + " " + str(result))
+
+    print("Tesla: Starting timer with an interval of " + str(g_t_sec) + " seconds")
+    g_supervisor.add(Component("poller", lambda: asyncio.create_task(timer_loop()), g_wd_timer, healthy=timer_healthy))
+
+# Called once we're watching for rain: MQTT subscribed to our stations, or the first timer run when we only have OWM. Puts it
+# in our systemd status and measures how long it took since we started. systemd was told we're ready by main() already
+def report_ready(how):
+    if not g_core.post("ready"):
+        return
+
+    elapsed = process_age()
+    if elapsed is None:
+        elapsed = time.monotonic() - g_started
+    g_metrics.observe("startup", elapsed)
+    printWithTime("Tesla: Ready, watching for rain with " + how + " {:.2f}".format(elapsed) + " seconds after we were launched")
+    sd_notify("STATUS=Watching for rain with " + how)
+
+# Seconds since our process was launched, including Python's own start up and our imports. None if /proc can't tell us
+def process_age():
+    try:
+        with open("/proc/self/stat") as f:
+            started = int(f.read().rsplit(")", 1)[1].split()[19]) / os.sysconf("SC_CLK_TCK")
+        with open("/proc/uptime") as f:
+            uptime = float(f.read().split()[0])
+        return max(0.0, uptime - started)
+    except (OSError, IndexError, ValueError):
+        return None
+
+# Sends 'state' to systemd if it started us as a Type=notify service
+def sd_notify(state):
+    address = os.environ.get("NOTIFY_SOCKET")
+    if address is None or address == "":
+        return
+    if address.startswith("@"):
+        address = "\0" + address[1:] # Abstract socket
+    try:
+        with socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM) as sock:
+            sock.connect(address)
+            sock.sendall(state.encode("utf-8"))
+    except OSError as error:
+        printWithTime("Tesla: Unable to notify systemd because of exception: " + type(error).__name__)
+
+# Everything runs as tasks of a single event loop: the MQTT connection, the timer and the supervisor watching them. Blocking
+# calls (HTTP) are sent to worker threads and awaited so they never hold up the others. Emails have their own thread
+async def main():
+    loop = asyncio.get_running_loop()
+    g_core.start(loop)
+    tasks = []
+
+    g_supervisor.add(Component("notifier", g_outbox.start, 90, stop=g_outbox.stop))
+
+    # Set up our MQTT connection if we have something
+    if not g_skip_mqtt:
+        import paho.mqtt.client as mqtt
+        mqtt_client = mqtt.Client()
+        mqtt_client.on_connect = on_mqtt_connect
+        mqtt_client.on_subscribe = on_mqtt_subscribe
+        mqtt_client.on_message = on_mqtt_message
+
+        if Config.getboolean('MQTT', 'use_tls') == True:
+            mqtt_client.tls_set()
+        mqtt_client.username_pw_set(username = Config.get('MQTT', 'username'), password = Config.get('MQTT', 'password'))
+        mqtt_client.connect_async(Config.get('MQTT', 'hostname'), int(Config.get('MQTT', 'port')), 60)
+
+        print("Tesla: Connecting to MQTT...")
+        helper = MqttAsyncioHelper(loop, mqtt_client)
+        g_supervisor.add(Component("mqtt", lambda: asyncio.create_task(helper.run(reconnect=True)), None, healthy=mqtt_healthy), asyncio.create_task(helper.run()))
+        g_supervisor.add(Component("ingest", lambda: asyncio.create_task(mqtt_consumer()), None))
+        g_supervisor.add(Component("rain", lambda: asyncio.create_task(rain_worker()), g_wd_timer))
+
+        if g_metrics_topic is not None:
+            print("Tesla: Publishing metrics on '" + g_metrics_topic + "' every " + str(g_metrics_interval) + " seconds")
+            tasks.append(asyncio.create_task(metrics_loop(mqtt_client, g_metrics_topic, g_metrics_interval)))
+
+    metrics_server = None
+    if g_metrics_port is not None:
+        print("Tesla: Serving metrics on port " + str(g_metrics_port))
+        metrics_server = await asyncio.start_server(serve_metrics, g_metrics_address, g_metrics_port)
+
+    run_task(startup())
+
+    # Our loop and supervisor are up, which is all systemd needs to know. Waiting for the broker here would have systemd kill us
+    # at its start timeout when it's down at boot, instead of letting us reconnect. Our status says what we're waiting for
+    sd_notify("READY=1\nSTATUS=Started, " + ("waiting for the first timer run" if g_skip_mqtt else "connecting to MQTT"))
+
+    print("Tesla: Starting supervisor, restarting what's stuck for more than " + str(g_wd_timer) + " seconds or without MQTT data for " + str(g_wd_mqtt_max) + " seconds")
+    try:
+        await g_supervisor.run()
+    finally:
+        for task in tasks + list(g_tasks) + [component.handle for component in g_supervisor.components.values() if isinstance(component.handle, asyncio.Task)]:
+            task.cancel()
+        if metrics_server is not None: # Stop listening so our port is free for the process systemd starts next
+            metrics_server.close()
 
 ####### Start here
 
@@ -735,118 +2502,360 @@ Config.read("check_tesla_windows_mqtt.ini")
 
 # Initialise our global variables
 tesla = None
-vin = Config.get('Tesla', 'vin')
-tessie_token = Config.get('Tesla', 'tessie_token')
+if Config.has_option('Tesla', 'url'):
+    tessie_url = Config.get('Tesla', 'url')
+else:
+    tessie_url = "https://api.tessie.com"
+
+g_core = Core() # Our shared state, read through g_core.view
+
+# Our metrics, always collected and optionally served as Prometheus text and/or published on an MQTT topic
+g_metrics = Metrics()
+if Config.has_option('Metrics', 'port') and Config.get('Metrics', 'port') != "":
+    g_metrics_port = int(Config.get('Metrics', 'port'))
+else:
+    g_metrics_port = None
+if Config.has_option('Metrics', 'address'):
+    g_metrics_address = Config.get('Metrics', 'address')
+else:
+    g_metrics_address = "127.0.0.1"
+if Config.has_option('Metrics', 'topic') and Config.get('Metrics', 'topic') != "":
+    g_metrics_topic = Config.get('Metrics', 'topic')
+else:
+    g_metrics_topic = None
+if Config.has_option('Metrics', 'interval'):
+    g_metrics_interval = int(Config.get('Metrics', 'interval'))
+else:
+    g_metrics_interval = 60
+
+# What we receive and send can be recorded to be played back later by replay_tesla_windows.py
+if Config.has_option('Record', 'file') and Config.get('Record', 'file') != "":
+    g_recorder = Recorder(Config.get('Record', 'file'))
+    print("Tesla: Recording to " + Config.get('Record', 'file'))
+else:
+    g_recorder = None
+# 'vin' can be a comma separated list of vehicles. 'tessie_token' is either one token for all of them or one per vehicle
+vins = [value.strip() for value in Config.get('Tesla', 'vin').split(",")]
+tessie_tokens = [value.strip() for value in Config.get('Tesla', 'tessie_token').split(",")]
+if len(tessie_tokens) == 1:
+    tessie_tokens = tessie_tokens * len(vins)
+elif len(tessie_tokens) != len(vins):
+    print("Tesla: Need one tessie_token or one per vin, quitting")
+    quit(1)
 wake_at_start = int(Config.get('Tesla', 'wake_at_start'))
 sendTo = Config.get('Email', 'to')
+if Config.has_option('Email', 'server'):
+    smtp_server = Config.get('Email', 'server')
+else:
+    smtp_server = 'smtp.gmail.com'
+if Config.has_option('Email', 'port'):
+    smtp_port = int(Config.get('Email', 'port'))
+else:
+    smtp_port = 587
+if Config.has_option('Email', 'use_tls'):
+    smtp_tls = Config.getboolean('Email', 'use_tls')
+else:
+    smtp_tls = True
 sendDailyEmail = Config.getboolean('Email', 'daily_status')
-station_latitude = float(Config.get('MQTT', 'latitude'))
-station_longitude = float(Config.get('MQTT', 'longitude'))
+
+# Our emails are sent from a background thread
+if Config.has_option('Email', 'queue_size'):
+    email_queue_size = int(Config.get('Email', 'queue_size'))
+else:
+    email_queue_size = 50
+if Config.has_option('Email', 'retries'):
+    email_retries = int(Config.get('Email', 'retries'))
+else:
+    email_retries = 3
+if Config.has_option('Email', 'digest'):
+    email_digest = int(Config.get('Email', 'digest'))
+else:
+    email_digest = 0
+g_outbox = EmailOutbox(email_queue_size, email_retries, email_digest) # Started by main() under our supervisor
 
 g_t_sec = int(Config.get('Timers', 'Timer'))
+# Each vehicle is checked between every 'min_poll' and 'max_poll' seconds depending on its state, the weather and the time to sunset
+if Config.has_option('Timers', 'min_poll'):
+    g_poll_min = int(Config.get('Timers', 'min_poll'))
+else:
+    g_poll_min = g_t_sec
+if Config.has_option('Timers', 'parked_poll'):
+    g_poll_parked = int(Config.get('Timers', 'parked_poll'))
+else:
+    g_poll_parked = 300
+if Config.has_option('Timers', 'max_poll'):
+    g_poll_max = int(Config.get('Timers', 'max_poll'))
+else:
+    g_poll_max = 1800
 g_wd_timer = int(Config.get('Timers', 'WatchDog'))
 g_wd_mqtt_max = int(Config.get('Timers', 'MQTT_Max'))
+
+# Our supervisor restarts a stuck part of our work instead of the whole program, unless it had to be restarted more than
+# 'max_restarts' times in 'restart_window' seconds
+if Config.has_option('Timers', 'max_restarts'):
+    supervisor_max_restarts = int(Config.get('Timers', 'max_restarts'))
+else:
+    supervisor_max_restarts = 5
+if Config.has_option('Timers', 'restart_window'):
+    supervisor_window = int(Config.get('Timers', 'restart_window'))
+else:
+    supervisor_window = 600
+g_supervisor = Supervisor(supervisor_max_restarts, supervisor_window, g_wd_timer)
 g_debug = int(Config.get('Debug', 'Debug_level'))
 print("Tesla: Debug level is " + str(g_debug))
 
-max_distance = float(Config.get('MQTT', 'max_distance'))
+# A station is raining once the rain of the last 'rain_window' seconds adds up to 'rain_start' cm/h and stops once it's down to
+# 'rain_stop'. Its outside temperature is averaged over 'temp_window' seconds
+if Config.has_option('MQTT', 'rain_window'):
+    g_rain_window = float(Config.get('MQTT', 'rain_window'))
+else:
+    g_rain_window = 600.0
+if Config.has_option('MQTT', 'rain_start'):
+    g_rain_start = float(Config.get('MQTT', 'rain_start'))
+else:
+    g_rain_start = 0.3
+if Config.has_option('MQTT', 'rain_stop'):
+    g_rain_stop = float(Config.get('MQTT', 'rain_stop'))
+else:
+    g_rain_stop = 0.0
+if Config.has_option('MQTT', 'temp_window'):
+    g_temp_window = float(Config.get('MQTT', 'temp_window'))
+else:
+    g_temp_window = 300.0
+
+# Our weather stations. The one in [MQTT] is named 'station' and others have their own '[Station name]' section
+g_stations = []
+if Config.has_option('MQTT', 'latitude') and Config.get('MQTT', 'latitude') != "":
+    if Config.has_option('MQTT', 'topic'):
+        station_topic = Config.get('MQTT', 'topic')
+    else:
+        station_topic = "acurite/loop"
+    g_stations.append(Station("station", station_topic, Config.get('MQTT', 'latitude'), Config.get('MQTT', 'longitude'), Config.get('MQTT', 'max_distance')))
+for section in Config.sections():
+    if section.startswith("Station "):
+        g_stations.append(Station(section[8:].strip(), Config.get(section, 'topic'), Config.get(section, 'latitude'), Config.get(section, 'longitude'), Config.get(section, 'max_distance')))
+if len(g_stations) == 0:
+    print("Tesla: Need the position of at least one weather station, quitting")
+    quit(1)
+if len(g_stations) > 1:
+    for station in g_stations:
+        station.suffix = " at station '" + station.name + "'"
+g_stations_by_topic = {station.topic: station for station in g_stations}
+g_station_index = StationIndex(g_stations, 0.25)
+
+# Where we assume the vehicle is when it doesn't report its position
+station_latitude = g_stations[0].fence.latitude
+station_longitude = g_stations[0].fence.longitude
+
+# Our stations are always geofences. Others can be added in the [Geofences] section as 'name: latitude, longitude, radius in km'
+g_geofences = {station.name: station.fence for station in g_stations}
+if Config.has_section('Geofences'):
+    for name, value in Config.items('Geofences'):
+        fence_latitude, fence_longitude, fence_radius = value.split(",")
+        g_geofences[name] = Geofence(name, fence_latitude, fence_longitude, fence_radius)
+
 if Config.has_option('OWM', 'api_key'):
     print("Tesla: Will use OWM")
     owm_key = Config.get('OWM', 'api_key')
 else:
     print("Tesla: Will NOT use OWM")
     owm_key = None
-    
-g_mqtt_lastRun = datetime.now()
-g_mqtt_ran = True
-g_timer_lastRun = datetime.now()
-g_timer_ran = True
-g_night = False
-g_out_temp = None
-g_already_sent_email_after_error = False
-g_retry = 0
-g_in_timer = 0
-g_timeout_count = 0
-
-# These are our Tesla data we need to keep while we're running
-g_windows = None
-g_moving = None
-g_latitude = None
-g_longitude = None
-g_mqtt_raining = False
-g_owm_raining = False
-g_kill_prog = False
-
-# Set up our MQTT connection if we have something
-#breakpoint() ############################################## BREAKPOINT ##############################################
-if Config.has_option('MQTT', 'hostname'):
-    g_skip_mqtt = False
-    
-    mqtt_client = mqtt.Client()
-    mqtt_client.on_connect = on_mqtt_connect
-    mqtt_client.on_message = on_mqtt_message
 
-    if Config.getboolean('MQTT', 'use_tls') == True:
-        mqtt_client.tls_set()
-    mqtt_client.username_pw_set(username = Config.get('MQTT', 'username'), password = Config.get('MQTT', 'password'))
+if Config.has_option('OWM', 'url'):
+    owm_url = Config.get('OWM', 'url')
+else:
+    owm_url = "https://api.openweathermap.org"
 
-    print("Tesla: Connecting to MQTT...")
-    try:
-        mqtt_client.connect(Config.get('MQTT', 'hostname'), int(Config.get('MQTT', 'port')), 60)
-    except Exception as error:
-        emailBody = "Unable to connect to MQTT. Error " + type(error).__name__
-        emailSubject = "Tesla: " + emailBody
+# OWM answers are cached per geohash cell until the station is expected to have a new observation
+if Config.has_option('OWM', 'geohash_precision'):
+    owm_precision = int(Config.get('OWM', 'geohash_precision'))
+else:
+    owm_precision = 5
+if Config.has_option('OWM', 'refresh'):
+    owm_refresh = int(Config.get('OWM', 'refresh'))
+else:
+    owm_refresh = 600
+if Config.has_option('OWM', 'daily_quota'):
+    owm_daily_quota = int(Config.get('OWM', 'daily_quota'))
+else:
+    owm_daily_quota = 1000
+if Config.has_option('OWM', 'cache_file') and Config.get('OWM', 'cache_file') != "":
+    owm_cache_file = Config.get('OWM', 'cache_file')
+else:
+    owm_cache_file = None
+g_weather = WeatherCache(owm_precision, owm_refresh, 60, owm_refresh * 2, owm_daily_quota, owm_cache_file)
+
+# OWM's minutely precipitation forecast (One Call), to close the windows before the rain gets here. Has its own cache and quota
+g_nowcast = None
+if owm_key is not None and Config.has_option('OWM', 'nowcast') and Config.getboolean('OWM', 'nowcast'):
+    print("Tesla: Will use OWM's minutely forecast")
+    if Config.has_option('OWM', 'nowcast_lead'):
+        g_nowcast_lead = int(Config.get('OWM', 'nowcast_lead')) * 60
+    else:
+        g_nowcast_lead = 15 * 60
+    if Config.has_option('OWM', 'nowcast_threshold'):
+        g_nowcast_threshold = float(Config.get('OWM', 'nowcast_threshold'))
+    else:
+        g_nowcast_threshold = 0.5
+    if Config.has_option('OWM', 'nowcast_refresh'):
+        nowcast_refresh = int(Config.get('OWM', 'nowcast_refresh'))
+    else:
+        nowcast_refresh = owm_refresh
+    if Config.has_option('OWM', 'nowcast_daily_quota'):
+        nowcast_daily_quota = int(Config.get('OWM', 'nowcast_daily_quota'))
+    else:
+        nowcast_daily_quota = 1000
+    nowcast_cache_file = None
+    if owm_cache_file is not None:
+        nowcast_cache_file = owm_cache_file + ".nowcast"
+    g_nowcast = WeatherCache(owm_precision, nowcast_refresh, 60, nowcast_refresh, nowcast_daily_quota, nowcast_cache_file, "onecall", "/data/3.0/onecall?exclude=current,hourly,daily,alerts&")
+
+# OWM icons from 'rain_icon_min' to 'rain_icon_max' mean it's raining (9: Shower rain, 10: Rain, 11: Thunderstorm)
+if Config.has_option('OWM', 'rain_icon_min'):
+    g_rain_icon_min = int(Config.get('OWM', 'rain_icon_min'))
+else:
+    g_rain_icon_min = 9
+if Config.has_option('OWM', 'rain_icon_max'):
+    g_rain_icon_max = int(Config.get('OWM', 'rain_icon_max'))
+else:
+    g_rain_icon_max = 11
 
-        if g_already_sent_email_after_error == False:
-            g_already_sent_email_after_error = True
+# When the cabin can overheat: a daytime OWM icon up to 'sunny_icon_max' (some sun showing), more than 'sun_margin' hours after
+# sunrise and before sunset, warmer than 'warm_temp' outside and with at least 'min_soc' percent of battery to keep it cool
+if Config.has_option('Heat', 'sunny_icon_max'):
+    g_sunny_icon_max = int(Config.get('Heat', 'sunny_icon_max'))
+else:
+    g_sunny_icon_max = 3
+if Config.has_option('Heat', 'sun_margin'):
+    g_sun_margin = float(Config.get('Heat', 'sun_margin'))
+else:
+    g_sun_margin = 3.0
+if Config.has_option('Heat', 'warm_temp'):
+    g_warm_temp = float(Config.get('Heat', 'warm_temp'))
+else:
+    g_warm_temp = 10.0
+if Config.has_option('Heat', 'min_soc'):
+    g_min_soc = int(Config.get('Heat', 'min_soc'))
+else:
+    g_min_soc = 20
 
-            try:
-                sender = Emailer()
-                sender.sendmail(sendTo, emailSubject, emailBody)
-            except Exception as error:
-                printWithTime("Tesla: Unable to send email because of exception: " + type(error).__name__)
+# Pooled keep-alive HTTP sessions shared by Tessie and OWM
+if Config.has_option('HTTP', 'pool_size'):
+    http_pool_size = int(Config.get('HTTP', 'pool_size'))
+else:
+    http_pool_size = 2
+if Config.has_option('HTTP', 'timeout'):
+    http_timeout = int(Config.get('HTTP', 'timeout'))
+else:
+    http_timeout = 10
+g_http = HttpClient(http_pool_size, http_timeout)
 
-        printWithTime("Tesla: " + emailBody)
-    
-elif owm_key is not None:
-    g_skip_mqtt = True
-    print("Tesla: Skipping MQTT, will only use OWM")
+# How many calls we allow ourselves per minute and per day (UTC) for each API, 0 means no limit. The last 'reserve' share of
+# each budget is kept for closing the windows. OWM's calls per day are limited by [OWM] daily_quota instead
+if Config.has_option('Budget', 'reserve'):
+    budget_reserve = float(Config.get('Budget', 'reserve'))
 else:
-    print("Tesla: No MQTT and no OWM, what are we supposed to do here? Quitting")
-    quit(1)
+    budget_reserve = 0.2
+g_budgets = Budgets(budget_reserve)
+if Config.has_option('Budget', 'tessie_per_minute'):
+    tessie_per_minute = int(Config.get('Budget', 'tessie_per_minute'))
+else:
+    tessie_per_minute = 30
+if Config.has_option('Budget', 'tessie_per_day'):
+    tessie_per_day = int(Config.get('Budget', 'tessie_per_day'))
+else:
+    tessie_per_day = 0
+g_budgets.add("tessie", tessie_per_minute, tessie_per_day)
+if Config.has_option('Budget', 'owm_per_minute'):
+    owm_per_minute = int(Config.get('Budget', 'owm_per_minute'))
+else:
+    owm_per_minute = 60
+g_budgets.add("owm", owm_per_minute, 0)
 
-print("Tesla: Checking vehicle's status")
-vehicle_status = get_vehicle_status()
-if (vehicle_status == "asleep" or vehicle_status == "waiting_for_sleep"):
-    if wake_at_start == 1:
-        print("Waking up vehicle " + vin)
-        response = tessie("wake", "", g_wd_timer)
-    else:
-        print("Vehicle " + vin + " is asleep and we're not requesting it to be waken up")
-elif vehicle_status == "awake":
-    print("Vehicle " + vin + " is already awake")
+# After 'threshold' failures in a row we stop calling an API for 'backoff' seconds, doubled each time it still doesn't answer up
+# to 'max_backoff', then try a single call
+if Config.has_option('Circuit', 'threshold'):
+    circuit_threshold = int(Config.get('Circuit', 'threshold'))
+else:
+    circuit_threshold = 3
+if Config.has_option('Circuit', 'backoff'):
+    circuit_backoff = float(Config.get('Circuit', 'backoff'))
+else:
+    circuit_backoff = 30.0
+if Config.has_option('Circuit', 'max_backoff'):
+    circuit_max_backoff = float(Config.get('Circuit', 'max_backoff'))
+else:
+    circuit_max_backoff = 900.0
+g_breakers = {
+    "tessie": CircuitBreaker("Tessie", circuit_threshold, circuit_backoff, circuit_max_backoff, True),
+    "owm": CircuitBreaker("OWM", circuit_threshold, circuit_backoff, circuit_max_backoff, True),
+    "smtp": CircuitBreaker("SMTP", circuit_threshold, circuit_backoff, circuit_max_backoff, False) # Nothing to email it with
+}
+
+# Vehicle data read from Tessie is shared between the timer and MQTT threads for that many seconds
+if Config.has_option('Tesla', 'snapshot_ttl'):
+    snapshot_ttl = int(Config.get('Tesla', 'snapshot_ttl'))
+else:
+    snapshot_ttl = 30
+# Once a vehicle said its windows are closed, we don't send it another 'close_windows' for that many seconds
+if Config.has_option('Tesla', 'close_cooldown'):
+    close_cooldown = int(Config.get('Tesla', 'close_cooldown'))
 else:
-    print("Vehicle " + vin + " returned a status of " + vehicle_status)
+    close_cooldown = 120
+g_vehicles = [Vehicle(vins[i], tessie_tokens[i], snapshot_ttl, close_cooldown) for i in range(len(vins))]
+g_vehicles_by_vin = {vehicle.vin: vehicle for vehicle in g_vehicles}
 
-print("Running first instance of the timer thread")
-on_timer()
+# Vehicle states can be pushed to us on that MQTT topic, from a streaming bridge for example. Those vehicles are then only polled every 'poll' seconds
+if Config.has_option('Push', 'topic'):
+    g_push_topic = Config.get('Push', 'topic')
+else:
+    g_push_topic = None
+if Config.has_option('Push', 'poll'):
+    g_push_poll = int(Config.get('Push', 'poll'))
+else:
+    g_push_poll = 3600
+if len(g_vehicles) > 1:
+    print("Tesla: Watching " + str(len(g_vehicles)) + " vehicles")
+    for vehicle in g_vehicles:
+        vehicle.suffix = " (" + vehicle.vin + ")"
+
+# Maximum number of vehicles we're talking to Tessie about at the same time
+if Config.has_option('Tesla', 'max_concurrent'):
+    g_fleet_slots = asyncio.Semaphore(int(Config.get('Tesla', 'max_concurrent')))
+else:
+    g_fleet_slots = asyncio.Semaphore(2)
 
-print("Tesla: Starting timer thread with an interval of " + str(g_t_sec) + " seconds")
-T = RepeatTimer(g_t_sec, on_timer)
-T.start()
+# Sun times are computed once a day, or when the vehicle moves more than 0.1 degree (about 11 km, less than a minute of sun time)
+g_ephemeris = Ephemeris(pytz.timezone('America/Toronto'), 0.1)
+    
+g_tasks = set() # Background tasks we started and are still running
+g_poll_now = asyncio.Event() # Set to have the timer run right away instead of waiting for its next tick
 
-print("Tesla: Waiting 30 seconds before starting watchdog thread")
-time.sleep(30)
+# Raw MQTT packets waiting to be decoded. When full, the oldest ones are dropped
+if Config.has_option('MQTT', 'queue_size'):
+    g_mqtt_queue = asyncio.Queue(int(Config.get('MQTT', 'queue_size')))
+else:
+    g_mqtt_queue = asyncio.Queue(100)
+g_rain_queue = asyncio.Queue(len(g_stations)) # Stations that just started raining, waiting for their vehicles to be checked
 
-print("Tesla: Starting watchdog thread with an interval of " + str(g_wd_timer) + " seconds and max time between MQTT event is " + str(g_wd_mqtt_max))
-W = RepeatTimer(g_wd_timer, on_watchdog)
-W.start()
+# Our decisions are kept in that file so a restart picks up where we left off
+if Config.has_option('State', 'file') and Config.get('State', 'file') != "":
+    if Config.has_option('State', 'max_age'):
+        g_state = StateStore(Config.get('State', 'file'), int(Config.get('State', 'max_age')))
+    else:
+        g_state = StateStore(Config.get('State', 'file'), 3600)
+    g_state.restore()
+    atexit.register(g_state.checkpoint, True)
+else:
+    g_state = None
 
-if g_skip_mqtt:
-    loop = asyncio.get_event_loop()
-    try:
-        loop.run_forever()
-    finally:
-        loop.close()
+if Config.has_option('MQTT', 'hostname'):
+    g_skip_mqtt = False
+elif owm_key is not None:
+    g_skip_mqtt = True
+    print("Tesla: Skipping MQTT, will only use OWM")
 else:
-    mqtt_client.loop_forever()
+    print("Tesla: No MQTT and no OWM, what are we supposed to do here? Quitting")
+    quit(1)
+
+asyncio.run(main())
@@ -0,0 +1,455 @@
+#!/usr/bin/env python3
+
+# Plays back a recording made with the [Record] section of check_tesla_windows_mqtt.ini. check_tesla_windows_mqtt.py runs
+# unchanged in its own process but talks to local stand-ins for the MQTT broker, Tessie, OWM and the SMTP server. The MQTT
+# packets are published again at 'speed' times their recorded pace and Tessie and OWM answer what they answered at that
+# point of the recording. At the end we report how long it took from the first rain packet to 'command/close_windows',
+# the API calls per simulated hour and the CPU and memory used per timer tick.
+#
+# The timers of the config are divided by 'speed' but sunrise and sunset still follow the real clock.
+#
+# Usage: replay_tesla_windows.py recording.jsonl.gz [--config check_tesla_windows_mqtt.ini] [--speed 10] [--json results.json]
+
+import sys
+import os
+import json
+import gzip
+import time
+import struct
+import shutil
+import asyncio
+import argparse
+import tempfile
+import configparser
+from urllib.parse import urlsplit
+from datetime import timedelta
+
+SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "check_tesla_windows_mqtt.py")
+
+def printWithTime(text):
+    print(time.strftime("%H:%M:%S") + " : " + text)
+
+def load_recording(filename):
+    opener = gzip.open if filename.endswith(".gz") else open
+    events = []
+    with opener(filename, "rt") as f:
+        for line in f:
+            line = line.strip()
+            if line != "":
+                events.append(json.loads(line))
+    events.sort(key=lambda event: event["t"])
+    return events
+
+# Same as redact_url() in check_tesla_windows_mqtt.py so the requests we get match what was recorded
+def redact_url(url):
+    parts = urlsplit(url)
+    query = "&".join(param for param in parts.query.split("&") if not param.startswith("appid="))
+    return parts.path + ("?" + query if query else "")
+
+def is_owm(path):
+    return path.startswith("/data/")
+
+def is_rain(event):
+    try:
+        rain_cm = json.loads(event["payload"]).get("rain_cm")
+        return rain_cm is not None and float(rain_cm) > 0.0
+    except (ValueError, AttributeError):
+        return False
+
+# Maps the time since the start of the replay to the time of the recording
+class Clock:
+    def __init__(self, recorded_start, speed):
+        self.recorded_start = recorded_start
+        self.speed = speed
+        self.start = None
+
+    def begin(self):
+        self.start = time.monotonic()
+
+    def recorded(self):
+        if self.start is None:
+            return self.recorded_start
+        return self.recorded_start + (time.monotonic() - self.start) * self.speed
+
+    def wall(self, recorded):
+        return self.start + (recorded - self.recorded_start) / self.speed
+
+# Stand-in for Tessie and OWM. Answers each request with what was recorded for that URL at or just before the current
+# recorded time. Commands that weren't recorded succeed
+class HttpStandIn:
+    def __init__(self, events, clock):
+        self.clock = clock
+        self.answers = {}   # redacted url -> [(t, status, body)]
+        self.by_path = {}   # path alone, for positions that moved a little since the recording
+        self.requests = []  # (monotonic, path)
+        for event in events:
+            if event["kind"] == "http":
+                answer = (event["t"], event["status"], event["body"])
+                self.answers.setdefault(event["url"], []).append(answer)
+                self.by_path.setdefault(event["url"].split("?")[0], []).append(answer)
+        self.port = None
+
+    async def start(self):
+        server = await asyncio.start_server(self.handle, "127.0.0.1", 0)
+        self.port = server.sockets[0].getsockname()[1]
+
+    def answer(self, url):
+        answers = self.answers.get(url)
+        if answers is None:
+            answers = self.by_path.get(url.split("?")[0])
+        if answers is None:
+            if "/command/" in url or url.endswith("/wake"):
+                return 200, json.dumps({"result": True, "woke": False})
+            return 404, "{}"
+        now = self.clock.recorded()
+        best = answers[0]
+        for answer in answers:
+            if answer[0] > now:
+                break
+            best = answer
+        return best[1], best[2]
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                request = await reader.readline()
+                if request == b"":
+                    break
+                while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                    pass
+                method, url, version = request.decode("latin-1").split(" ", 2)
+                url = redact_url(url)
+                self.requests.append((time.monotonic(), url))
+                status, body = self.answer(url)
+                body = body.encode("utf-8")
+                writer.write(("HTTP/1.1 " + str(status) + " X\r\nContent-Type: application/json\r\nContent-Length: " + str(len(body)) + "\r\n\r\n").encode("latin-1") + body)
+                await writer.drain()
+        except (ConnectionError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+# Stand-in for the MQTT broker, only what paho needs for QoS 0: connect, subscribe, publish, ping and disconnect
+class MqttStandIn:
+    def __init__(self):
+        self.subscriptions = [] # (topic, writer)
+        self.subscribed = asyncio.Event()
+        self.port = None
+
+    async def start(self):
+        server = await asyncio.start_server(self.handle, "127.0.0.1", 0)
+        self.port = server.sockets[0].getsockname()[1]
+
+    @staticmethod
+    def length(n):
+        out = b""
+        while True:
+            digit = n % 128
+            n = n // 128
+            if n > 0:
+                digit |= 0x80
+            out += bytes([digit])
+            if n == 0:
+                return out
+
+    async def handle(self, reader, writer):
+        try:
+            while True:
+                header = (await reader.readexactly(1))[0]
+                size = 0
+                multiplier = 1
+                while True:
+                    digit = (await reader.readexactly(1))[0]
+                    size += (digit & 127) * multiplier
+                    multiplier *= 128
+                    if digit & 128 == 0:
+                        break
+                body = await reader.readexactly(size)
+                packet = header >> 4
+                if packet == 1:     # CONNECT
+                    writer.write(b"\x20\x02\x00\x00")
+                elif packet == 8:   # SUBSCRIBE
+                    i = 2
+                    count = 0
+                    while i < len(body):
+                        topic_size = struct.unpack("!H", body[i:i + 2])[0]
+                        self.subscriptions.append((body[i + 2:i + 2 + topic_size].decode("utf-8"), writer))
+                        i += 3 + topic_size
+                        count += 1
+                    writer.write(b"\x90" + self.length(2 + count) + body[:2] + b"\x00" * count)
+                    self.subscribed.set()
+                elif packet == 12:  # PINGREQ
+                    writer.write(b"\xd0\x00")
+                elif packet == 14:  # DISCONNECT
+                    break
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.subscriptions = [(topic, subscriber) for topic, subscriber in self.subscriptions if subscriber is not writer]
+            writer.close()
+
+    def publish(self, topic, payload):
+        topic = topic.encode("utf-8")
+        payload = payload.encode("utf-8")
+        packet = b"\x30" + self.length(2 + len(topic) + len(payload)) + struct.pack("!H", len(topic)) + topic + payload
+        for subscription, writer in self.subscriptions:
+            if subscription == topic.decode("utf-8") or subscription == "#":
+                writer.write(packet)
+
+# Stand-in for the SMTP server, accepts any login and keeps the subjects of the emails
+class SmtpStandIn:
+    def __init__(self):
+        self.subjects = []
+        self.port = None
+
+    async def start(self):
+        server = await asyncio.start_server(self.handle, "127.0.0.1", 0)
+        self.port = server.sockets[0].getsockname()[1]
+
+    async def handle(self, reader, writer):
+        writer.write(b"220 replay ESMTP\r\n")
+        try:
+            while True:
+                line = await reader.readline()
+                if line == b"":
+                    break
+                command = line.decode("latin-1").strip().upper()
+                if command.startswith("EHLO"):
+                    writer.write(b"250-replay\r\n250 AUTH PLAIN LOGIN\r\n")
+                elif command.startswith("AUTH"):
+                    writer.write(b"235 OK\r\n")
+                elif command.startswith("DATA"):
+                    writer.write(b"354 Go ahead\r\n")
+                    await writer.drain()
+                    while True:
+                        data = await reader.readline()
+                        if data in (b".\r\n", b""):
+                            break
+                        if data.startswith(b"Subject: "):
+                            self.subjects.append(data[9:].decode("utf-8", "replace").strip())
+                    writer.write(b"250 OK\r\n")
+                elif command.startswith("QUIT"):
+                    writer.write(b"221 Bye\r\n")
+                    await writer.drain()
+                    break
+                else:
+                    writer.write(b"250 OK\r\n")
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+# Reads the CPU time (seconds) and the resident memory (MB) of a process from /proc
+def process_usage(pid):
+    try:
+        with open("/proc/" + str(pid) + "/stat") as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        cpu = (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+        rss = 0.0
+        with open("/proc/" + str(pid) + "/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    rss = int(line.split()[1]) / 1024.0
+        return cpu, rss
+    except (OSError, IndexError, ValueError):
+        return None
+
+# Our config with every service pointing to the stand-ins, the timers sped up and no recording or persistent cache
+def write_config(source, directory, speed, http, mqtt, smtp):
+    Config = configparser.ConfigParser()
+    Config.read(source)
+
+    def scaled(section, option, minimum):
+        if Config.has_option(section, option):
+            Config.set(section, option, str(max(minimum, int(round(int(Config.get(section, option)) / speed)))))
+
+    if Config.has_option('MQTT', 'hostname'):
+        Config.set('MQTT', 'hostname', "127.0.0.1")
+        Config.set('MQTT', 'port', str(mqtt.port))
+        Config.set('MQTT', 'use_tls', "False")
+    Config.set('Tesla', 'url', "http://127.0.0.1:" + str(http.port))
+    Config.set('Tesla', 'wake_at_start', "0")
+    scaled('Tesla', 'snapshot_ttl', 1)
+    if Config.has_section('OWM'):
+        Config.set('OWM', 'url', "http://127.0.0.1:" + str(http.port))
+        Config.set('OWM', 'cache_file', "")
+        scaled('OWM', 'refresh', 1)
+    Config.set('Email', 'server', "127.0.0.1")
+    Config.set('Email', 'port', str(smtp.port))
+    Config.set('Email', 'use_tls', "False")
+    for option in ('Timer', 'MQTT_Max', 'min_poll', 'parked_poll', 'max_poll'):
+        scaled('Timers', option, 1)
+    scaled('Push', 'poll', 1)
+    scaled('OWM', 'nowcast_refresh', 1)
+    scaled('Circuit', 'backoff', 1)
+    scaled('Circuit', 'max_backoff', 1)
+    if Config.has_section('Budget'): # Time runs 'speed' times faster, so do the calls
+        for option in ('tessie_per_minute', 'owm_per_minute'):
+            if Config.has_option('Budget', option):
+                Config.set('Budget', option, str(int(Config.get('Budget', option)) * int(max(1, round(speed)))))
+
+    # The stations' windows shrink with the timers, so the same rain falls in a shorter time and its rate (cm/h) goes up as much
+    for option, default in (('rain_window', 600), ('temp_window', 300)):
+        if Config.has_section('MQTT'):
+            Config.set('MQTT', option, str(max(1.0, float(Config.get('MQTT', option, fallback=str(default))) / speed)))
+    for option, default in (('rain_start', 0.3), ('rain_stop', 0.0)):
+        if Config.has_section('MQTT'):
+            Config.set('MQTT', option, str(float(Config.get('MQTT', option, fallback=str(default))) * speed))
+    timer = int(Config.get('Timers', 'Timer'))
+    Config.set('Timers', 'WatchDog', str(max(int(round(int(Config.get('Timers', 'WatchDog')) / speed)), timer + 10))) # The timer gets 'WatchDog' - 5 seconds
+    Config.set('Timers', 'MQTT_Max', str(max(int(Config.get('Timers', 'MQTT_Max')), 5)))
+    Config.remove_section('Record')
+
+    with open(os.path.join(directory, "check_tesla_windows_mqtt.ini"), "w") as f:
+        Config.write(f)
+
+def format_duration(seconds):
+    return str(timedelta(seconds=int(seconds)))
+
+async def replay(args):
+    events = load_recording(args.recording)
+    if len(events) == 0:
+        print("Nothing to replay in " + args.recording)
+        return None
+
+    recorded_start = events[0]["t"]
+    recorded_hours = max(events[-1]["t"] - recorded_start, 1.0) / 3600.0
+    clock = Clock(recorded_start, args.speed)
+
+    http = HttpStandIn(events, clock)
+    mqtt = MqttStandIn()
+    smtp = SmtpStandIn()
+    await http.start()
+    await mqtt.start()
+    await smtp.start()
+
+    directory = tempfile.mkdtemp(prefix="replay_tesla_")
+    write_config(args.config, directory, args.speed, http, mqtt, smtp)
+
+    process = await asyncio.create_subprocess_exec(sys.executable, "-u", SCRIPT, cwd=directory, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT)
+    ticks = []  # (cpu, rss) when each timer tick started
+
+    async def read_output():
+        while True:
+            line = await process.stdout.readline()
+            if line == b"":
+                break
+            line = line.decode("utf-8", "replace").rstrip()
+            if "Tesla-Timer: ****" in line:
+                usage = process_usage(process.pid)
+                if usage is not None:
+                    ticks.append(usage)
+            if args.verbose:
+                print("    " + line)
+
+    output = asyncio.ensure_future(read_output())
+
+    # Give it time to connect and do its first checks before we start the clock
+    try:
+        await asyncio.wait_for(mqtt.subscribed.wait(), 30)
+    except asyncio.TimeoutError:
+        printWithTime("Replay: The script never subscribed to MQTT, replaying anyway")
+    clock.begin()
+    printWithTime("Replay: Playing back " + str(len(events)) + " events (" + format_duration(recorded_hours * 3600) + ") at x" + str(args.speed))
+
+    first_rain = None
+    for event in events:
+        if event["kind"] != "mqtt":
+            continue
+        delay = clock.wall(event["t"]) - time.monotonic()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if process.returncode is not None:
+            break
+        mqtt.publish(event["topic"], event["payload"])
+        if first_rain is None and is_rain(event):
+            first_rain = time.monotonic()
+
+    await asyncio.sleep(max(0.0, clock.wall(events[-1]["t"]) - time.monotonic()) + args.settle)
+    replayed = time.monotonic() - clock.start
+    usage = process_usage(process.pid)
+
+    if process.returncode is None:
+        process.terminate()
+    await process.wait()
+    await output
+    if not args.keep:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    # What happened during the recording, to compare with
+    recorded_rain = next((event["t"] for event in events if event["kind"] == "mqtt" and is_rain(event)), None)
+    recorded_close = None
+    if recorded_rain is not None:
+        recorded_close = next((event["t"] for event in events if event["kind"] == "http" and "command/close_windows" in event["url"] and event["t"] >= recorded_rain), None)
+    recorded_tessie = sum(1 for event in events if event["kind"] == "http" and not is_owm(event["url"]))
+    recorded_owm = sum(1 for event in events if event["kind"] == "http" and is_owm(event["url"]))
+
+    # What happened now. Requests made before the clock started are part of the start up, not of the replay
+    requests = [(at, url) for at, url in http.requests if at >= clock.start]
+    simulated_hours = max(replayed * args.speed, 1.0) / 3600.0
+    tessie = sum(1 for at, url in requests if not is_owm(url))
+    owm = sum(1 for at, url in requests if is_owm(url))
+    close = None
+    if first_rain is not None:
+        close = next((at for at, url in requests if "command/close_windows" in url and at >= first_rain), None)
+
+    tick_cpu = [(ticks[i + 1][0] - ticks[i][0]) * 1000.0 for i in range(len(ticks) - 1)]
+    tick_rss = [rss for cpu, rss in ticks]
+
+    results = {
+        "recording": args.recording,
+        "speed": args.speed,
+        "recorded_seconds": round(recorded_hours * 3600, 1),
+        "replayed_seconds": round(replayed, 1),
+        "rain_to_close_seconds": None if first_rain is None or close is None else round(close - first_rain, 3),
+        "recorded_rain_to_close_seconds": None if recorded_close is None else round(recorded_close - recorded_rain, 3),
+        "tessie_calls_per_hour": round(tessie / simulated_hours, 1),
+        "owm_calls_per_hour": round(owm / simulated_hours, 1),
+        "recorded_tessie_calls_per_hour": round(recorded_tessie / recorded_hours, 1),
+        "recorded_owm_calls_per_hour": round(recorded_owm / recorded_hours, 1),
+        "emails": len(smtp.subjects),
+        "recorded_emails": sum(1 for event in events if event["kind"] == "email"),
+        "ticks": len(ticks),
+        "cpu_ms_per_tick": round(sum(tick_cpu) / len(tick_cpu), 2) if len(tick_cpu) > 0 else None,
+        "max_cpu_ms_per_tick": round(max(tick_cpu), 2) if len(tick_cpu) > 0 else None,
+        "rss_mb": round(sum(tick_rss) / len(tick_rss), 1) if len(tick_rss) > 0 else (None if usage is None else round(usage[1], 1)),
+        "max_rss_mb": round(max(tick_rss), 1) if len(tick_rss) > 0 else (None if usage is None else round(usage[1], 1)),
+        "cpu_seconds": None if usage is None else round(usage[0], 2),
+    }
+    return results
+
+def print_results(results):
+    print("Replayed " + format_duration(results["recorded_seconds"]) + " of recording in " + format_duration(results["replayed_seconds"]) + " (x" + str(results["speed"]) + ")")
+    if results["rain_to_close_seconds"] is not None:
+        print("Rain to close_windows: " + str(results["rain_to_close_seconds"]) + " s (recorded: " + str(results["recorded_rain_to_close_seconds"]) + " s)")
+    else:
+        print("Rain to close_windows: no close_windows after a rain packet (recorded: " + str(results["recorded_rain_to_close_seconds"]) + " s)")
+    print("Tessie calls per hour: " + str(results["tessie_calls_per_hour"]) + " (recorded: " + str(results["recorded_tessie_calls_per_hour"]) + ")")
+    print("OWM calls per hour: " + str(results["owm_calls_per_hour"]) + " (recorded: " + str(results["recorded_owm_calls_per_hour"]) + ")")
+    print("Emails: " + str(results["emails"]) + " (recorded: " + str(results["recorded_emails"]) + ")")
+    print("Timer ticks: " + str(results["ticks"]) + ", CPU per tick " + str(results["cpu_ms_per_tick"]) + " ms (max " + str(results["max_cpu_ms_per_tick"]) + " ms), memory " + str(results["rss_mb"]) + " MB (max " + str(results["max_rss_mb"]) + " MB), total CPU " + str(results["cpu_seconds"]) + " s")
+
+def main():
+    parser = argparse.ArgumentParser(description="Plays back a recording of check_tesla_windows_mqtt.py against local stand-ins and reports how it did")
+    parser.add_argument("recording", help="File written by the [Record] section")
+    parser.add_argument("--config", default=os.path.join(os.path.dirname(SCRIPT), "check_tesla_windows_mqtt.ini"), help="Config the recording was made with")
+    parser.add_argument("--speed", type=float, default=10.0, help="How many times faster than recorded to play it back")
+    parser.add_argument("--settle", type=float, default=10.0, help="Seconds to keep running after the last event")
+    parser.add_argument("--json", help="Also write the results to that file, to compare runs")
+    parser.add_argument("--keep", action="store_true", help="Keep the temporary directory the script ran in")
+    parser.add_argument("--verbose", action="store_true", help="Show the script's output")
+    args = parser.parse_args()
+
+    results = asyncio.run(replay(args))
+    if results is None:
+        sys.exit(1)
+
+    print_results(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=4)
+
+if __name__ == "__main__":
+    main()